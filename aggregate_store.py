@@ -0,0 +1,280 @@
+import json
+import pickle
+import shutil
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import file_signature, read_frame, replace_directory, write_frame
+from preparation import ABGroups, retention_days, uncensored_retention
+from upload_datasets import (
+    DatasetsPaths, aggregate_user_days, ampl_user_data_missing, csv_path, merge_user_days, upload_all_datasets,
+    upload_all_users_datasets, dataset_columns_map,
+)
+
+store_path = csv_path / '.aggregates'
+
+arm_absent = -3
+arm_hopping = -2
+
+retention_windows = sorted(set(retention_days.values()))
+
+store_metric_columns = {
+    'arpu': 'price_usd',
+    'messages': 'messages_count',
+}
+
+
+class IncrementalUnsupported(Exception):
+    pass
+
+
+def day_number(value) -> int:
+    return int(pd.Timestamp(value).normalize().value // (24 * 3600 * 10 ** 9))
+
+
+def group_days(dataset_paths: DatasetsPaths) -> dict[int, dict[str, tuple]]:
+    days: dict[int, dict[str, tuple]] = {}
+    for dataset, datasets in dataset_paths.items():
+        for dataset_date, dataset_path in datasets:
+            days.setdefault(day_number(dataset_date), {})[dataset] = (dataset_date, dataset_path)
+
+    return dict(sorted(days.items()))
+
+
+def day_signature(day_files: dict[str, tuple]) -> dict:
+    return {
+        dataset: file_signature(dataset_path)
+        for dataset, (_, dataset_path) in sorted(day_files.items())
+    }
+
+
+class AggregateStore:
+    def __init__(self, directory: Path = store_path):
+        self.directory = directory
+        self.reset()
+
+    def reset(self):
+        self.user_ids = np.empty(0, dtype=object)
+        self.columns = {
+            'first_day': np.empty(0, dtype='int64'),
+            'last_day': np.empty(0, dtype='int64'),
+            'price_usd': np.empty(0, dtype='float64'),
+            'messages_count': np.empty(0, dtype='int64'),
+            'retained': np.empty(0, dtype='uint8'),
+        }
+        self.arms: dict[str, np.ndarray] = {}
+        self.days: dict[str, dict] = {}
+        self.last_day: int | None = None
+        self.max_day: int | None = None
+        self.insert_ids: set = set()
+        self.last_payment_ts: pd.Timestamp | None = None
+
+    def load(self) -> bool:
+        users_directory = self.directory / 'users'
+        try:
+            with open(self.directory / 'manifest.json') as f:
+                manifest = json.load(f)
+            with open(self.directory / 'insert_ids.pkl', 'rb') as f:
+                self.insert_ids = pickle.load(f)
+        except (OSError, ValueError):
+            self.reset()
+            return False
+
+        users = read_frame(users_directory)
+        if users is None:
+            self.reset()
+            return False
+        self.user_ids = users['user_id'].to_numpy()
+        self.columns = {column: np.array(users[column]) for column in self.columns}
+        self.arms = {experiment: np.array(users[experiment]) for experiment in manifest['experiments']}
+        self.days = manifest['days']
+        self.last_day = manifest['last_day']
+        self.max_day = manifest['max_day']
+        self.last_payment_ts = pd.Timestamp(manifest['last_payment_ts']) if manifest['last_payment_ts'] else None
+
+        return True
+
+    def save(self, results: dict | None = None, fast: bool = False):
+        # the whole store is swapped in by one rename, so a crash never pairs a manifest with other days' sums
+        tmp_directory = self.directory.with_name(f'{self.directory.name}.{uuid.uuid4().hex}.tmp')
+        tmp_directory.mkdir(parents=True)
+        write_frame(pd.DataFrame({'user_id': self.user_ids, **self.columns, **self.arms}), tmp_directory / 'users')
+
+        with open(tmp_directory / 'insert_ids.pkl', 'wb') as f:
+            pickle.dump(self.insert_ids, f)
+        with open(tmp_directory / 'manifest.json', 'w') as f:
+            json.dump({
+                'experiments': list(self.arms),
+                'days': self.days,
+                'last_day': self.last_day,
+                'max_day': self.max_day,
+                'last_payment_ts': self.last_payment_ts.isoformat() if self.last_payment_ts is not None else None,
+            }, f)
+        # results computed from an older store are dropped with it
+        if results is not None:
+            with open(tmp_directory / 'results.pkl', 'wb') as f:
+                pickle.dump({'fast': fast, 'results': results}, f)
+
+        replace_directory(tmp_directory, self.directory)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.reset()
+
+    def transform_payments(self, payments: pd.DataFrame) -> pd.DataFrame:
+        if payments.empty:
+            return payments
+
+        payments = payments.assign(ts=pd.to_datetime(payments['ts'])).sort_values(['ts', 'insert_id'])
+        if self.last_payment_ts is not None and payments['ts'].iloc[0] < self.last_payment_ts:
+            raise IncrementalUnsupported('payments arrived out of timestamp order')
+
+        payments = payments.drop_duplicates(subset=['insert_id'], keep='first')
+        payments = payments[~payments['insert_id'].isin(self.insert_ids)]
+        if payments.empty:
+            return payments
+
+        timedelta = payments['ts'].diff()
+        if self.last_payment_ts is not None:
+            timedelta.iloc[0] = payments['ts'].iloc[0] - self.last_payment_ts
+        filtered = payments[timedelta.isna() | (timedelta >= pd.Timedelta(milliseconds=300))]
+
+        self.insert_ids.update(payments['insert_id'])
+        self.last_payment_ts = payments['ts'].iloc[-1]
+
+        return filtered
+
+    def add_users(self, user_ids: np.ndarray):
+        if not len(self.user_ids):
+            self.user_ids = np.empty(0, dtype=user_ids.dtype)
+        new_ids = np.setdiff1d(user_ids, self.user_ids)
+        if not len(new_ids):
+            return
+
+        user_ids = np.concatenate([self.user_ids, new_ids])
+        order = np.argsort(user_ids, kind='stable')
+        self.user_ids = user_ids[order]
+        self.columns = {
+            column: np.concatenate([values, np.zeros(len(new_ids), dtype=values.dtype)])[order]
+            for column, values in self.columns.items()
+        }
+        self.arms = {
+            experiment: np.concatenate([arms, np.full(len(new_ids), arm_absent, dtype='int8')])[order]
+            for experiment, arms in self.arms.items()
+        }
+
+    def apply_day(self, day: int, merged: pd.DataFrame, experiments: list[str]) -> set[str]:
+        if self.last_day is not None and day <= self.last_day:
+            raise IncrementalUnsupported('new day is not after the last ingested day')
+        self.last_day = day
+        if merged.empty:
+            return set()
+
+        for experiment in experiments:
+            if experiment not in self.arms:
+                self.arms[experiment] = np.full(len(self.user_ids), ampl_user_data_missing, dtype='int8')
+
+        is_new = ~np.isin(merged['user_id'].to_numpy(), self.user_ids)
+        self.add_users(merged['user_id'].to_numpy())
+        positions = np.searchsorted(self.user_ids, merged['user_id'].to_numpy())
+        self.columns['first_day'][positions[is_new]] = day
+
+        affected = set()
+        for experiment, arms in self.arms.items():
+            values = merged[experiment].to_numpy() if experiment in merged else \
+                np.full(len(merged), ampl_user_data_missing, dtype='int8')
+            previous = arms[positions]
+            arms[positions] = np.where(previous == arm_absent, values, np.where(previous == values, previous, arm_hopping))
+            if ((previous >= 0) | (values >= 0)).any():
+                affected.add(experiment)
+
+        offsets = day - self.columns['first_day'][positions]
+        for bit, window in enumerate(retention_windows):
+            self.columns['retained'][positions[offsets == window]] |= np.uint8(1 << bit)
+
+        self.columns['price_usd'][positions] += merged['price_usd'].to_numpy().astype('float32')
+        self.columns['messages_count'][positions] += merged['messages_count'].to_numpy().astype('int32')
+        self.columns['last_day'][positions] = day
+
+        previous_max_day = self.max_day if self.max_day is not None else day
+        self.max_day = day
+        matured = np.zeros(len(self.user_ids), dtype=bool)
+        for window in retention_windows:
+            matured |= (self.columns['first_day'] + window > previous_max_day) & (self.columns['first_day'] + window <= day)
+        for experiment, arms in self.arms.items():
+            if (arms[matured] >= 0).any():
+                affected.add(experiment)
+
+        return affected
+
+    def ingest(self, dataset_paths: DatasetsPaths, cores: int | None = None) -> tuple[set[str], dict]:
+        days = group_days(dataset_paths)
+        ingested = {int(day) for day in self.days}
+        changed = [day for day in ingested if day not in days or day_signature(days[day]) != self.days[str(day)]]
+        if changed or (ingested and min(set(days) - ingested, default=max(ingested) + 1) <= max(ingested)):
+            print('Warning! Previously ingested days changed or were backfilled; rebuilding aggregate store')
+            self.clear()
+            ingested = set()
+
+        affected = set()
+        for day, day_files in days.items():
+            if day in ingested:
+                continue
+            affected.update(self.apply_day(day, *self.load_day(day_files, cores)))
+            self.days[str(day)] = day_signature(day_files)
+
+        return affected, {'days_total': len(days), 'days_skipped': len(ingested), 'days_ingested': len(days) - len(ingested)}
+
+    def load_day(self, day_files: dict[str, tuple], cores: int | None = None) -> tuple[pd.DataFrame, list[str]]:
+        experiments, users = [], pd.DataFrame()
+        if 'users' in day_files:
+            experiments, users = upload_all_users_datasets([day_files['users']], cores)
+
+        aggregates = []
+        for dataset, column in [('messages', 'messages_count'), ('payments', 'price_usd')]:
+            if dataset in day_files:
+                data = upload_all_datasets(dataset, [day_files[dataset]], dataset_columns_map[dataset], cores)
+                if dataset == 'payments':
+                    data = aggregate_user_days(self.transform_payments(data), column)
+            else:
+                data = pd.DataFrame({'user_id': [], 'date': [], column: []})
+            aggregates.append((data, column))
+
+        if users.empty:
+            return users, experiments
+        return merge_user_days(users, aggregates), experiments
+
+    def load_results(self, fast: bool) -> dict:
+        try:
+            with open(self.directory / 'results.pkl', 'rb') as f:
+                stored = pickle.load(f)
+        except (OSError, ValueError, pickle.UnpicklingError):
+            return {}
+
+        return stored['results'] if stored['fast'] == fast else {}
+
+    def groups(self, experiment: str, metrics: list[str]) -> dict[tuple[str, str], ABGroups]:
+        arms = self.arms[experiment]
+        selected = arms >= 0
+        if (arms == arm_hopping).any():
+            print(f'Warning! Users change their A/B groups in experiment: {experiment}')
+
+        groups = {}
+        for metric in metrics:
+            if metric in store_metric_columns:
+                values = self.columns[store_metric_columns[metric]].astype(float)
+                observable = selected
+            else:
+                window = retention_days[metric]
+                bit = np.uint8(1 << retention_windows.index(window))
+                values = ((self.columns['retained'] & bit) > 0).astype(int)
+                observable = selected
+                if metric not in uncensored_retention:
+                    observable = selected & (self.columns['first_day'] + window <= self.max_day)
+
+            groups[experiment, metric] = values[observable & (arms == 0)], values[observable & (arms == 1)]
+
+        return groups
@@ -0,0 +1,307 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from resampling import bootstrap_a12, bootstrap_diff_means, percentile_ci
+from synthetic import SyntheticConfig, generate_datasets
+from telemetry import peak_rss_mb, reset_peak_rss
+from upload_datasets import (
+    aggregate_user_days, compact_merged_frame, dataset_columns_map, get_dataset_names, merge_user_days,
+    transform_payments, upload_all_datasets, upload_all_users_datasets,
+)
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def benchmark_bootstrap(n_users: int = 20000, n_resamples: int = 2000, alpha: float = 0.12, seed: int = 8):
+    data_rng = np.random.default_rng(seed)
+    a = data_rng.exponential(1.0, size=n_users)
+    b = data_rng.exponential(1.05, size=n_users)
+
+    def diff_means(x, y):
+        return float(np.mean(y) - np.mean(x))
+
+    scipy_result, scipy_time = timed(
+        stats.bootstrap,
+        data=(a, b),
+        statistic=diff_means,
+        paired=False,
+        confidence_level=1 - alpha,
+        vectorized=False,
+        n_resamples=n_resamples,
+        method='percentile',
+        rng=np.random.default_rng(seed),
+    )
+    engine_result, engine_time = timed(bootstrap_diff_means, a, b, n_resamples, np.random.default_rng(seed))
+
+    scipy_ci = (float(scipy_result.confidence_interval.low), float(scipy_result.confidence_interval.high))
+    engine_ci = percentile_ci(engine_result, alpha)
+
+    print(f'bootstrap n_users={n_users} n_resamples={n_resamples}')
+    print(f'- scipy.stats.bootstrap: {scipy_time:.3f}s; CI {scipy_ci}')
+    print(f'- bootstrap_diff_means: {engine_time:.3f}s; CI {engine_ci}; speedup x{scipy_time / engine_time:.1f}')
+
+    return {
+        'scipy_seconds': scipy_time,
+        'engine_seconds': engine_time,
+        'scipy_ci': scipy_ci,
+        'engine_ci': engine_ci,
+    }
+
+
+def benchmark_mannwhitney(n_users: int = 20000, n_resamples: int = 200, alpha: float = 0.12, seed: int = 8):
+    data_rng = np.random.default_rng(seed)
+    a = data_rng.poisson(0.5, size=n_users).astype(float)
+    b = data_rng.poisson(0.55, size=n_users).astype(float)
+
+    def loop_a12(rng):
+        boot_vals = np.empty(n_resamples, dtype=float)
+        for i in range(n_resamples):
+            a_s = rng.choice(a, size=len(a), replace=True)
+            b_s = rng.choice(b, size=len(b), replace=True)
+            u_s = stats.mannwhitneyu(a_s, b_s, alternative='two-sided', method='asymptotic').statistic
+            boot_vals[i] = u_s / (len(a) * len(b))
+        return boot_vals
+
+    loop_result, loop_time = timed(loop_a12, np.random.default_rng(seed))
+    engine_result, engine_time = timed(bootstrap_a12, a, b, n_resamples, np.random.default_rng(seed))
+
+    loop_ci = percentile_ci(loop_result, alpha)
+    engine_ci = percentile_ci(engine_result, alpha)
+
+    print(f'mannwhitney n_users={n_users} n_resamples={n_resamples}')
+    print(f'- mannwhitneyu loop: {loop_time:.3f}s; CI {loop_ci}')
+    print(f'- bootstrap_a12: {engine_time:.3f}s; CI {engine_ci}; speedup x{loop_time / engine_time:.1f}')
+
+    return {
+        'loop_seconds': loop_time,
+        'engine_seconds': engine_time,
+        'loop_ci': loop_ci,
+        'engine_ci': engine_ci,
+    }
+
+
+def synthetic_merged_frame(
+        n_users: int = 200000,
+        n_days: int = 14,
+        n_experiments: int = 5,
+        seed: int = 8,
+) -> tuple[list[str], pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    first_day = rng.integers(0, n_days, size=n_users)
+    active = (rng.random((n_users, n_days)) < 0.4) | (np.arange(n_days) == first_day[:, None])
+    active &= np.arange(n_days) >= first_day[:, None]
+    user_idx, day_idx = np.nonzero(active)
+    n_rows = len(user_idx)
+
+    experiments = [f'exp{i}' for i in range(n_experiments)]
+    arms = rng.choice(np.array([True, False, None], dtype=object), size=(n_users, n_experiments), p=[0.45, 0.45, 0.1])
+    paid = rng.random(n_rows) < 0.05
+    dates = pd.Timestamp('2025-01-01') + pd.to_timedelta(day_idx, unit='D')
+
+    df = pd.DataFrame({
+        'user_id': [f'user-{i}' for i in user_idx],
+        'ts_x': dates,
+        'date': dates.date,
+        **{experiment: arms[user_idx, i] for i, experiment in enumerate(experiments)},
+        'messages_count': rng.poisson(3, size=n_rows) * (rng.random(n_rows) < 0.6),
+        'insert_id': np.where(paid, [f'insert-{i}' for i in range(n_rows)], None),
+        'ts_y': dates.where(paid),
+        'price_usd': np.where(paid, rng.choice([0.99, 4.99, 9.99], size=n_rows), 0.0),
+    })
+
+    return experiments, df
+
+
+def memory_report(n_users: int = 200000, n_days: int = 14, n_experiments: int = 5):
+    experiments, df = synthetic_merged_frame(n_users, n_days, n_experiments)
+    before = df.memory_usage(deep=True)
+    compact, compact_time = timed(compact_merged_frame, df, experiments)
+    after = compact.memory_usage(deep=True)
+
+    print(f'merged frame memory: {len(df)} rows, {n_users} users, {n_experiments} experiments')
+    for column in before.index:
+        if column == 'Index':
+            continue
+        compact_bytes = after.get(column, 0)
+        print(f'- {column}: {before[column] / 1024 / 1024:.1f} MB -> {compact_bytes / 1024 / 1024:.1f} MB')
+    print(
+        f'- total: {before.sum() / 1024 / 1024:.1f} MB -> {after.sum() / 1024 / 1024:.1f} MB '
+        f'(x{before.sum() / after.sum():.1f} smaller; compacted in {compact_time:.2f}s)'
+    )
+
+    return {
+        'rows': len(df),
+        'before_bytes': int(before.sum()),
+        'after_bytes': int(after.sum()),
+    }
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def children_peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def profile_stage(stages: dict, name: str, func, *args, **kwargs):
+    reset_peak_rss()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    cpu_started = time.process_time() + children_cpu_seconds()
+    children_peak_before = children_peak_rss_mb()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result, seconds = timed(func, *args, **kwargs)
+
+    # pool workers parse in their own processes; their peak cannot be reset, so a stage only reports it
+    # when one of its workers set a new high
+    children_peak = children_peak_rss_mb()
+    stages[name] = {
+        'seconds': seconds,
+        'cpu_seconds': time.process_time() + children_cpu_seconds() - cpu_started,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_worker_rss_mb': children_peak if children_peak > children_peak_before else None,
+        'peak_traced_mb': tracemalloc.get_traced_memory()[1] / 1024 / 1024 if tracemalloc.is_tracing() else None,
+    }
+    worker_peak = stages[name]['peak_worker_rss_mb']
+    print(
+        f'- {name}: {seconds:.2f}s; peak RSS {stages[name]["peak_rss_mb"]:.0f} MB'
+        + (f', workers {worker_peak:.0f} MB' if worker_peak is not None else '')
+    )
+
+    return result
+
+
+def ingest(directory: Path, cores: int | None = None):
+    dataset_paths = get_dataset_names(directory)
+    experiments, users = upload_all_users_datasets(dataset_paths['users'], cores)
+    messages = upload_all_datasets('messages', dataset_paths['messages'], dataset_columns_map['messages'], cores)
+    payments = upload_all_datasets('payments', dataset_paths['payments'], dataset_columns_map['payments'], cores)
+
+    return experiments, users, messages, aggregate_user_days(transform_payments(payments), 'price_usd')
+
+
+def merge(experiments, users, messages, payments) -> pd.DataFrame:
+    merged = merge_user_days(users, [(messages, 'messages_count'), (payments, 'price_usd')])
+    return compact_merged_frame(merged, experiments)
+
+
+def run_test_impl(test, groups, n_resamples: int) -> list:
+    return [
+        test(experiment, metric, a, b, n_resamples=n_resamples)
+        for (experiment, metric), (a, b) in groups.items()
+    ]
+
+
+def benchmark_pipeline(
+        config: SyntheticConfig,
+        n_resamples: int = 10000,
+        cores: int | None = None,
+        trace_memory: bool = False,
+) -> dict:
+    from calculate import build_groups, report_results, tests
+
+    print(f'pipeline n_users={config.n_users} n_days={config.n_days} n_experiments={config.n_experiments}')
+    stages = {}
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='abtests-benchmark-') as directory:
+            directory = Path(directory)
+            profile_stage(stages, 'generate', generate_datasets, directory, config)
+            ingested = profile_stage(stages, 'ingest', ingest, directory, cores)
+            profile_stage(stages, 'ingest_cached', ingest, directory, cores)
+            df = profile_stage(stages, 'merge', merge, *ingested)
+            del ingested
+
+            experiments = sorted(column for column in df.columns if column.startswith('exp'))
+            groups = profile_stage(stages, 'prepare', build_groups, df, experiments)
+            groups = {key: (a, b) for key, (a, b) in groups.items() if len(a) and len(b)}
+
+            results = {}
+            for test_name, test in tests.items():
+                for test_result in profile_stage(stages, f'test:{test_name}', run_test_impl, test, groups, n_resamples):
+                    results.setdefault(test_result.experiment, {}).setdefault(test_result.metric, []).append(test_result)
+            profile_stage(stages, 'report', report_results, results)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'n_users': config.n_users,
+        'n_days': config.n_days,
+        'n_experiments': config.n_experiments,
+        'n_resamples': n_resamples,
+        'rows': len(df),
+        'groups': len(groups),
+        'stages': stages,
+    }
+
+
+def benchmark_sweep(
+        sizes: list[int],
+        report_path: Path,
+        n_days: int = 14,
+        n_experiments: int = 2,
+        n_resamples: int = 10000,
+        cores: int | None = None,
+        trace_memory: bool = False,
+) -> dict:
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'host': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'runs': [
+            benchmark_pipeline(SyntheticConfig(n_users=n_users, n_days=n_days, n_experiments=n_experiments),
+                               n_resamples, cores, trace_memory)
+            for n_users in sizes
+        ],
+    }
+
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'report written to {report_path}')
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resampling micro benchmarks and end-to-end pipeline sweep')
+    parser.add_argument('--sweep', type=int, nargs='+', help='user counts for the end-to-end sweep, e.g. 10000 10000000')
+    parser.add_argument('--report', type=Path, default=Path('benchmark_report.json'))
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--experiments', type=int, default=2)
+    parser.add_argument('--n-resamples', type=int, default=10000)
+    parser.add_argument('--cores', type=int)
+    parser.add_argument('--trace-memory', action='store_true', help='also record tracemalloc peaks (slow)')
+    args = parser.parse_args()
+
+    if args.sweep:
+        benchmark_sweep(args.sweep, args.report, args.days, args.experiments, args.n_resamples, args.cores,
+                        args.trace_memory)
+    else:
+        benchmark_bootstrap()
+        benchmark_mannwhitney()
+        memory_report()
@@ -1,40 +1,37 @@
 import numpy as np
-import pandas as pd
-from scipy import stats
-from scipy.stats._resampling import BootstrapResult
 
-from preparation import get_aggregated_a_b_groups
+from resample_cache import bootstrap_statistic, cached_resample
+from resampling import percentile_ci
+from sufficient_stats import SufficientStats, normal_mean_diff
 
 
 def bootstrap_test_impl(
         experiment: str,
         metric: str,
-        df: pd.DataFrame,
+        a: np.ndarray,
+        b: np.ndarray,
         alpha: float = 0.12,
         n_resamples: int = 10000,
+        fast: bool = False,
+        chunks: int | None = None,
+        method: str | None = None,
 ):
     from calculate import TestResult
-    rng = np.random.default_rng(8)
+    seed = 8
 
-    a, b = get_aggregated_a_b_groups(df, experiment, metric)
     delta = b.mean() - a.mean()
 
-    def diff_means(x, y):
-        return float(np.mean(y) - np.mean(x))
-
-    result: BootstrapResult = stats.bootstrap(
-        data=(a, b),
-        statistic=diff_means,
-        paired=False,
-        confidence_level=1 - alpha,
-        vectorized=False,
-        n_resamples=n_resamples,
-        method='percentile',
-        rng=rng
-    )
-    # p_bt = float(np.mean(np.abs(result.bootstrap_distribution) >= abs(delta)))
-    p_bt = float(np.mean(result.bootstrap_distribution >= delta))
-    ci_lo, ci_hi = result.confidence_interval.low, result.confidence_interval.high
+    if fast:
+        normal = normal_mean_diff(SufficientStats.from_array(a), SufficientStats.from_array(b), alpha)
+        bootstrap_distribution = None
+        # P(delta* >= delta) for delta* ~ N(delta, se)
+        p_bt = 0.5 if normal.se else 1.0
+        ci_lo, ci_hi = normal.ci
+    else:
+        bootstrap_distribution = cached_resample(bootstrap_statistic(method), a, b, n_resamples, seed, chunks)
+        # p_bt = float(np.mean(np.abs(bootstrap_distribution) >= abs(delta)))
+        p_bt = float(np.mean(bootstrap_distribution >= delta))
+        ci_lo, ci_hi = percentile_ci(bootstrap_distribution, alpha)
 
     direction = None
     if p_bt > alpha:
@@ -63,7 +60,7 @@ def bootstrap_test_impl(
         direction=direction,
         ci=(ci_lo, ci_hi),
         vis_info={
-            'resample_distribution': result.bootstrap_distribution,
+            'resample_distribution': bootstrap_distribution,
             'delta_hat': delta,
         }
     )
@@ -1,17 +1,23 @@
-import os
-from collections import defaultdict
 from dataclasses import dataclass
 from itertools import product
 from typing import Any
 
+import numpy as np
 import pandas as pd
-import pebble
 
 from bootstrap_test import bootstrap_test_impl
+from executor import Executor, executor_scope
 from mannwhitney_test import mannwhitney_test_impl
 from permutation_test import permutation_test_impl
-from preparation import prepare_for_experiment
+from preparation import (
+    ABGroups, aggregate_experiment_groups, compute_user_retention, metrics_agg_map, prepare_experiments,
+)
+from resample_cache import ResampleCache, use_resample_cache
+from results_store import results_table, save_results
+from scheduler import Task, run_tasks
+from shared_arrays import SharedArrays
 from t_test import t_test_impl
+from telemetry import count, span
 
 
 @dataclass
@@ -26,6 +32,8 @@ class TestResult:
     decision: str | None = None
     direction: str | None = None
     reason: str | None = None
+    n_resamples: int | None = None
+    time_saved: float | None = None
     vis_info: dict[str, Any] | None = None
 
 
@@ -37,65 +45,132 @@ tests = {
 }
 
 
+test_cost_weights = {
+    'bootstrap_test': 1.0,
+    't_test': 2.0,
+    'permutation': 2.5,
+    'mannwhitney': 0.2,
+}
+
+metrics = list(metrics_agg_map)
+
+fast_tests = {'bootstrap_test', 't_test', 'permutation'}
+
+
+def estimate_task_cost(test_name: str, a: np.ndarray, b: np.ndarray) -> float:
+    return test_cost_weights[test_name] * (len(a) + len(b))
+
+
 def run_test(args):
-    test_name, metric, experiment, df = args
+    test_name, metric, experiment, handle_a, handle_b, fast, resample_cache = args
 
     assert test_name in tests, f'{test_name} not in tests'
 
     test = tests[test_name]
+    kwargs = {'fast': True} if fast and test_name in fast_tests else {}
 
+    use_resample_cache(resample_cache)
     try:
-        result = test(experiment, metric, df)
+        result = test(experiment, metric, handle_a.load(), handle_b.load(), **kwargs)
     except Exception as e:
         print(f'error in {test_name}: {e}')
         raise e
+    finally:
+        use_resample_cache(None)
 
     return result
 
 
-def run_experiments(df: pd.DataFrame, experiments: list[str]) -> dict[str, dict[str, list[TestResult]]]:
-    tasks = [
-        (experiment, prepare_for_experiment(df, experiment))
-        for experiment in experiments
-    ]
-    tasks = [
-        (metric, experiment, df)
-        for metric, (experiment, df) in product(['arpu', 'messages', 'user_retention'], tasks)
-    ]
-
-    tasks = [
-        (test, metric, experiment, df)
-        for test, (metric, experiment, df) in product(tests.keys(), tasks)
-    ]
-    tasks = [
-        tuple(task)
-        for task in tasks
-    ]
-    results: dict[str, dict[str, list[TestResult]]] = defaultdict(lambda: defaultdict(list))
-
-    with pebble.ProcessPool(min(len(tasks), os.cpu_count() - 2)) as pool:
-        map_future = pool.map(run_test, tasks)
-
-        for test_result in map_future.result():
+ExperimentsResults = dict[str, dict[str, list[TestResult]]]
+
+
+def build_groups(df: pd.DataFrame, experiments: list[str]) -> dict[tuple[str, str], ABGroups]:
+    with span('prepare', rows=len(df), experiments=len(experiments)):
+        selections = prepare_experiments(df, experiments)
+    with span('retention', rows=len(df)):
+        retention = compute_user_retention(df)
+    groups_cache: dict[tuple[str, str], ABGroups] = {}
+    for experiment in experiments:
+        with span('aggregate', experiment=experiment, rows=len(selections[experiment])):
+            groups_cache.update(aggregate_experiment_groups(df, experiment, metrics, selections[experiment], retention))
+        for metric in metrics:
+            a, b = groups_cache[experiment, metric]
+            count(f'users:{experiment}', **{f'{metric}_a': len(a), f'{metric}_b': len(b)})
+
+    return groups_cache
+
+
+def run_groups(
+        groups_cache: dict[tuple[str, str], ABGroups],
+        cores: int | None = None,
+        fast: bool = False,
+        executor: Executor | None = None,
+) -> ExperimentsResults:
+    results: ExperimentsResults = {}
+
+    for (experiment, metric), (a, b) in list(groups_cache.items()):
+        if len(a) == 0 or len(b) == 0:
+            print(f'Warning! Not enough data for {experiment}-{metric}: group sizes a={len(a)} b={len(b)}')
+            del groups_cache[experiment, metric]
+
+    with SharedArrays() as shared:
+        resample_cache = ResampleCache(shared.directory / 'resamples')
+        with span('publish', groups=len(groups_cache)):
+            handles = {
+                key: (shared.publish(a), shared.publish(b))
+                for key, (a, b) in groups_cache.items()
+            }
+        tasks = [
+            Task(
+                func=run_test,
+                args=((test, metric, experiment, *handles[experiment, metric], fast, resample_cache),),
+                cost=estimate_task_cost(test, a, b),
+                name=f'{test}:{experiment}:{metric}',
+            )
+            for test, ((experiment, metric), (a, b)) in product(tests.keys(), groups_cache.items())
+        ]
+        del groups_cache
+
+        with span('tests', tasks=len(tasks)), executor_scope(executor, cores) as tests_executor:
+            test_results = run_tasks(tasks, cores, tests_executor)
+        for test_result in test_results:
             test_result: TestResult | None = test_result
             if not test_result:
                 continue
-            results[test_result.experiment][test_result.metric].append(test_result)
+            results.setdefault(test_result.experiment, {}).setdefault(test_result.metric, []).append(test_result)
+
+        cache_stats = resample_cache.stats()
+        print(f'Resample cache: {cache_stats["hits"]} hits, {cache_stats["misses"]} misses')
+
+    return results
 
-    for experiment, experiment_test_results in results.items():
+
+def run_experiments(
+        df: pd.DataFrame,
+        experiments: list[str],
+        cores: int | None = None,
+        fast: bool = False,
+        executor: Executor | None = None,
+) -> ExperimentsResults:
+    results = run_groups(build_groups(df, experiments), cores, fast, executor)
+    with span('save_results'):
+        stored = save_results(results)
+    print(f'Results saved as run {stored.run_id}')
+    with span('report'):
+        report_table(stored.table)
+
+    return results
+
+
+def report_results(results: ExperimentsResults):
+    report_table(results_table(results))
+
+
+def report_table(table: pd.DataFrame):
+    for experiment, experiment_table in table.groupby('experiment', sort=False):
         print(f'####### {experiment} ####### ')
-        results_df = pd.DataFrame(columns=['test', 'metric', 'decision', 'direction', 'reason'])
-
-        for metric, metric_tests_results in experiment_test_results.items():
-            for test_result in sorted(metric_tests_results, key=lambda x: x.test_name):
-                row = {
-                    'test': test_result.test_name,
-                    'metric': metric,
-                    'decision': test_result.decision,
-                    'direction': test_result.direction,
-                    'reason': test_result.reason
-                }
-                results_df = pd.concat([results_df, pd.DataFrame([row])], ignore_index=True)
+        results_df = experiment_table[['test_name', 'metric', 'decision', 'direction', 'reason']] \
+            .rename(columns={'test_name': 'test'}).reset_index(drop=True)
 
         decisions = results_df['decision'].unique()
         if len(decisions) == 1 and decisions[0] == 'REJECT':
@@ -105,7 +180,7 @@ def run_experiments(df: pd.DataFrame, experiments: list[str]) -> dict[str, dict[
             exps_to_keep_running = results_df[['test', 'metric', 'reason']][
                 results_df['decision'] == 'KEEP_RUNNING'].to_numpy()
 
-            for test, metric, reason in exps_to_keep_running.values():
+            for test, metric, reason in exps_to_keep_running:
                 print(f'Test {test} for metric {metric} should KEEP RUNNING because\n- {reason}')
         else:
             directions = results_df.dropna()['direction'].unique()
@@ -139,5 +214,3 @@ def run_experiments(df: pd.DataFrame, experiments: list[str]) -> dict[str, dict[
                 )
 
     print('Done!')
-
-    return results
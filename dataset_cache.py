@@ -0,0 +1,126 @@
+import contextlib
+import errno
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+cache_dir_name = '.cache'
+cache_meta_name = 'meta.json'
+cache_version = 3
+
+
+def replace_directory(source: Path, target: Path):
+    # rename only lands on a missing or empty directory, so an existing entry is renamed away first;
+    # readers in between find no entry and treat it as a miss
+    try:
+        os.rename(source, target)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+
+    retired = target.with_name(f'{target.name}.{uuid.uuid4().hex}.old')
+    with contextlib.suppress(FileNotFoundError):
+        os.rename(target, retired)
+    try:
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        # a concurrent writer got its entry in first; keeping it is as good as a cache hit
+        shutil.rmtree(source, ignore_errors=True)
+    shutil.rmtree(retired, ignore_errors=True)
+
+
+def write_frame(df: pd.DataFrame, directory: Path, meta: dict | None = None):
+    # every writer fills its own directory, so processes sharing an entry never see each other's files
+    tmp_directory = directory.with_name(f'{directory.name}.{uuid.uuid4().hex}.tmp')
+    tmp_directory.mkdir(parents=True)
+
+    columns = []
+    for i, (name, column) in enumerate(df.items()):
+        values = column.to_numpy()
+        if pd.api.types.infer_dtype(column, skipna=False) == 'date':
+            kind = 'date'
+            values = values.astype('datetime64[D]')
+        elif values.dtype == object:
+            kind = 'object'
+        else:
+            kind = 'array'
+        np.save(tmp_directory / f'{i}.npy', values, allow_pickle=kind == 'object')
+        columns.append({'name': name, 'kind': kind})
+
+    with open(tmp_directory / cache_meta_name, 'w') as f:
+        json.dump({**(meta or {}), 'columns': columns, 'rows': len(df)}, f)
+
+    replace_directory(tmp_directory, directory)
+
+
+def read_frame_meta(directory: Path) -> dict | None:
+    try:
+        with open(directory / cache_meta_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_frame(directory: Path) -> pd.DataFrame | None:
+    meta = read_frame_meta(directory)
+    if meta is None:
+        return None
+
+    data = {}
+    try:
+        for i, column in enumerate(meta['columns']):
+            path = directory / f'{i}.npy'
+            if column['kind'] == 'object':
+                data[column['name']] = np.load(path, allow_pickle=True)
+            elif column['kind'] == 'date':
+                data[column['name']] = np.load(path).astype(object)
+            else:
+                data[column['name']] = np.load(path, mmap_mode='r')
+    except (OSError, ValueError, KeyError, EOFError):
+        # the entry was replaced by another process while it was being read
+        return None
+
+    return pd.DataFrame(data, copy=False)
+
+
+def file_signature(path: Path) -> dict:
+    stat = path.stat()
+    return {'source': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': cache_version}
+
+
+def cache_entry(path: Path) -> Path:
+    return path.parent / cache_dir_name / path.stem
+
+
+def cache_status(path: Path) -> str:
+    meta = read_frame_meta(cache_entry(path))
+    if meta is None:
+        return 'new'
+
+    signature = file_signature(path)
+    if all(meta.get(key) == value for key, value in signature.items()):
+        return 'cached'
+    return 'stale'
+
+
+def load_cached(path: Path, parse: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    directory = cache_entry(path)
+    if cache_status(path) == 'cached':
+        df = read_frame(directory)
+        if df is not None:
+            return df
+
+    signature = file_signature(path)
+    df = parse()
+    write_frame(df, directory, signature)
+
+    return df
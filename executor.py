@@ -0,0 +1,424 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import pickle
+import queue
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from multiprocessing.connection import (
+    AuthenticationError, Client, Connection, Listener, answer_challenge, deliver_challenge, wait,
+)
+from typing import Any
+
+import numpy as np
+
+from resample_cache import ResampleCache
+from scheduler import Task, run_tasks_untraced
+from shared_arrays import ArrayHandle, SharedArrays
+
+executor_env = 'ABTESTS_EXECUTOR'
+executor_key_env = 'ABTESTS_EXECUTOR_KEY'
+# the constant key earlier versions fell back to is public, so it is refused like any short key
+retired_executor_keys = {b'abtests'}
+min_executor_key_length = 16
+
+poll_seconds = 0.1
+handshake_seconds = 10.0
+heartbeat_seconds = 5.0
+worker_lost_seconds = 30.0
+worker_wait_seconds = 60.0
+reconnect_seconds = 1.0
+max_task_attempts = 3
+
+
+class Executor(ABC):
+    @abstractmethod
+    def run(self, tasks: list[Task]) -> list[Any]:
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'Executor':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InProcessExecutor(Executor):
+    def run(self, tasks: list[Task]) -> list[Any]:
+        return run_tasks_untraced(tasks, cores=1)
+
+
+class LocalPoolExecutor(Executor):
+    def __init__(self, cores: int | None = None):
+        self.cores = cores
+
+    def run(self, tasks: list[Task]) -> list[Any]:
+        return run_tasks_untraced(tasks, self.cores)
+
+
+def map_values(value, convert):
+    if isinstance(value, tuple):
+        return tuple(map_values(item, convert) for item in value)
+    if isinstance(value, list):
+        return [map_values(item, convert) for item in value]
+    if isinstance(value, dict):
+        return {key: map_values(item, convert) for key, item in value.items()}
+
+    return convert(value)
+
+
+def task_values(task: Task, kind: type) -> list:
+    values = []
+
+    def collect(value):
+        if isinstance(value, kind):
+            values.append(value)
+        return value
+
+    map_values((task.args, task.kwargs), collect)
+    return values
+
+
+@dataclass(eq=False)
+class WorkerLink:
+    conn: Connection
+    name: str
+    arrays: set[str] = field(default_factory=set)
+    task: tuple[int, int] | None = None
+    seen: float = field(default_factory=time.monotonic)
+
+
+class TcpExecutor(Executor):
+    def __init__(self, address: tuple[str, int], authkey: bytes | None = None,
+                 worker_wait: float = worker_wait_seconds, max_attempts: int = max_task_attempts):
+        # authentication runs on the handshake threads, so the listener itself takes no key
+        self.listener = Listener(address)
+        self.address = self.listener.address
+        # without an explicit key only the workers started by spawn_workers can ever join
+        self.authkey = check_executor_key(authkey) if authkey else secrets.token_hex(32).encode()
+        self.spawned: list[subprocess.Popen] = []
+        self.worker_wait = worker_wait
+        self.max_attempts = max_attempts
+        self.workers: list[WorkerLink] = []
+        self.runs = 0
+        self.joined: queue.SimpleQueue = queue.SimpleQueue()
+        self.closed = False
+        self.accepter = threading.Thread(target=self.accept, daemon=True)
+        self.accepter.start()
+
+    def accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                if self.closed:
+                    return
+                continue
+            threading.Thread(target=self.handshake, args=(conn,), daemon=True).start()
+
+    def handshake(self, conn: Connection):
+        # a peer that connects and stays silent is cut off here and never reaches the scheduling loop
+        deadline = threading.Timer(handshake_seconds, shutdown_connection, args=(conn,))
+        deadline.start()
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+            kind, name = conn.recv()
+            assert kind == 'ready', f'unexpected {kind} message'
+        except (AuthenticationError, AssertionError, EOFError, OSError, ValueError) as e:
+            print(f'Warning! Rejected a worker connection: {e!r}')
+            conn.close()
+            return
+        finally:
+            deadline.cancel()
+        self.joined.put(WorkerLink(conn, name))
+
+    def spawn_workers(self, processes: int = 1):
+        host, port = self.address
+        command = [sys.executable, os.path.abspath(__file__), 'worker', f'{host}:{port}']
+        self.spawned.append(subprocess.Popen(
+            [*command, '--processes', str(processes), '--once'],
+            env={**os.environ, executor_key_env: self.authkey.decode()},
+        ))
+
+    def admit(self):
+        while not self.joined.empty():
+            self.workers.append(self.joined.get())
+            print(f'Worker {self.workers[-1].name} joined; {len(self.workers)} connected')
+
+    def lose(self, worker: WorkerLink, reason: str, pending: list[int], attempts: list[int], tasks: list[Task]):
+        worker.conn.close()
+        self.workers.remove(worker)
+        if worker.task is None or worker.task[0] != self.runs:
+            print(f'Warning! Worker {worker.name} lost ({reason})')
+            return
+
+        (_, i), worker.task = worker.task, None
+        attempts[i] += 1
+        if attempts[i] >= self.max_attempts:
+            raise RuntimeError(f'task {tasks[i].name} lost {attempts[i]} workers; last: {worker.name} ({reason})')
+        print(f'Warning! Worker {worker.name} lost ({reason}); retrying {tasks[i].name}')
+        pending.insert(0, i)
+
+    def assign(self, worker: WorkerLink, i: int, task: Task):
+        # each compact group array is shipped to a worker once and reused by all its later tasks
+        worker.task = (self.runs, i)
+        for handle in task_values(task, ArrayHandle):
+            if handle.path not in worker.arrays:
+                worker.conn.send(('array', handle.path, np.asarray(handle.load())))
+                worker.arrays.add(handle.path)
+        worker.conn.send(('task', worker.task, task.func, task.args, task.kwargs))
+
+    def next_task(self, worker: WorkerLink, pending: list[int], tasks: list[Task]) -> int:
+        for position, i in enumerate(pending):
+            if all(handle.path in worker.arrays for handle in task_values(tasks[i], ArrayHandle)):
+                return pending.pop(position)
+
+        return pending.pop(0)
+
+    def forget(self):
+        # arrays are published per run, so no later run can use them; workers drop them after their current task
+        for worker in self.workers:
+            if worker.arrays:
+                with contextlib.suppress(OSError):
+                    worker.conn.send(('forget', sorted(worker.arrays)))
+                worker.arrays.clear()
+
+    def run(self, tasks: list[Task]) -> list[Any]:
+        try:
+            return self.schedule(tasks)
+        finally:
+            self.forget()
+
+    def schedule(self, tasks: list[Task]) -> list[Any]:
+        # results of a previous, failed run may still arrive; they are told apart by the run number
+        self.runs += 1
+        pending = sorted(range(len(tasks)), key=lambda i: tasks[i].cost, reverse=True)
+        attempts = [0] * len(tasks)
+        results: list[Any] = [None] * len(tasks)
+        done = 0
+        waiting_since = time.monotonic()
+        if tasks and not self.workers:
+            print(f'Waiting for workers on {self.address[0]}:{self.address[1]}')
+
+        while done < len(tasks):
+            self.admit()
+            if self.workers:
+                waiting_since = time.monotonic()
+            elif time.monotonic() - waiting_since > self.worker_wait:
+                raise RuntimeError(f'no workers connected to {self.address} for {self.worker_wait:.0f}s')
+
+            for worker in list(self.workers):
+                if worker.task is None and pending:
+                    i = self.next_task(worker, pending, tasks)
+                    try:
+                        self.assign(worker, i, tasks[i])
+                    except OSError as e:
+                        self.lose(worker, repr(e), pending, attempts, tasks)
+
+            links = {worker.conn: worker for worker in self.workers}
+            for conn in wait(list(links), timeout=poll_seconds):
+                worker = links[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError) as e:
+                    self.lose(worker, repr(e), pending, attempts, tasks)
+                    continue
+
+                worker.seen = time.monotonic()
+                if message[0] not in ('result', 'error'):
+                    continue
+                _, (run, i), value, lookups = message
+                worker.task = None
+                if run != self.runs:
+                    continue
+                # workers resample into caches of their own; their lookups count towards the run's cache
+                for resample_cache in task_values(tasks[i], ResampleCache):
+                    resample_cache.record_lookups(**lookups)
+                if message[0] == 'result':
+                    results[i] = value
+                    done += 1
+                else:
+                    print(f'error in {tasks[i].name} on worker {worker.name}: {value}')
+                    raise value
+
+            for worker in list(self.workers):
+                if time.monotonic() - worker.seen > worker_lost_seconds:
+                    self.lose(worker, f'silent for {worker_lost_seconds:.0f}s', pending, attempts, tasks)
+
+        return results
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        self.admit()
+        for worker in self.workers:
+            with contextlib.suppress(OSError):
+                worker.conn.send(('stop',))
+            worker.conn.close()
+        self.workers = []
+        for process in self.spawned:
+            try:
+                process.wait(timeout=handshake_seconds)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.spawned = []
+
+
+def shutdown_connection(conn: Connection):
+    # shutting the socket down wakes a thread blocked in recv on it, which close alone does not
+    with contextlib.suppress(OSError), socket.socket(fileno=os.dup(conn.fileno())) as sock:
+        sock.shutdown(socket.SHUT_RDWR)
+
+
+def work(conn: Connection, shared: SharedArrays):
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def heartbeat():
+        while not stopped.wait(heartbeat_seconds):
+            try:
+                send(('alive',))
+            except OSError:
+                return
+
+    def localize(value):
+        if isinstance(value, ArrayHandle):
+            return arrays[value.path]
+        if isinstance(value, ResampleCache):
+            return resample_cache
+        return value
+
+    def lookups_since(before: dict[str, int]) -> dict[str, int]:
+        return {key: count - before[key] for key, count in resample_cache.stats().items()}
+
+    arrays: dict[str, ArrayHandle] = {}
+    resample_cache = ResampleCache(shared.directory / 'resamples')
+    send(('ready', f'{socket.gethostname()}:{os.getpid()}'))
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == 'stop':
+                return
+            if message[0] == 'array':
+                _, path, array = message
+                arrays[path] = shared.publish(array)
+            elif message[0] == 'forget':
+                for path in message[1]:
+                    with contextlib.suppress(KeyError, FileNotFoundError):
+                        os.remove(arrays.pop(path).path)
+            elif message[0] == 'task':
+                _, i, func, args, kwargs = message
+                before = resample_cache.stats()
+                try:
+                    result = func(*map_values(args, localize), **map_values(kwargs, localize))
+                except Exception as e:
+                    send(('error', i, e if is_picklable(e) else RuntimeError(repr(e)), lookups_since(before)))
+                    continue
+                send(('result', i, result, lookups_since(before)))
+    except (EOFError, OSError):
+        return
+    finally:
+        stopped.set()
+        conn.close()
+
+
+def is_picklable(value) -> bool:
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+def serve_worker(address: tuple[str, int], authkey: bytes, once: bool = False):
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+        except OSError:
+            # the coordinator only listens while run_groups is running
+            time.sleep(reconnect_seconds)
+            continue
+
+        with SharedArrays() as shared:
+            work(conn, shared)
+        if once:
+            return
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    host, _, port = value.removeprefix('tcp://').rpartition(':')
+    assert host and port.isdigit(), f'{value} is not a host:port address'
+
+    return host, int(port)
+
+
+def check_executor_key(key: bytes) -> bytes:
+    assert key not in retired_executor_keys, 'the old default executor key is public; choose a new secret'
+    assert len(key) >= min_executor_key_length, f'executor keys must be at least {min_executor_key_length} bytes'
+
+    return key
+
+
+def executor_key() -> bytes:
+    key = os.environ.get(executor_key_env)
+    # tasks are pickled, so anyone holding the key can run code on the coordinator and the workers
+    assert key, f'set {executor_key_env} to a secret shared by the coordinator and its workers'
+
+    return check_executor_key(key.encode())
+
+
+def create_executor(spec: str | None = None, cores: int | None = None) -> Executor:
+    spec = spec or os.environ.get(executor_env, 'local')
+    if spec == 'inprocess':
+        return InProcessExecutor()
+    if spec == 'local':
+        return LocalPoolExecutor(cores)
+    assert spec.startswith('tcp://'), f'{spec} is not an executor; use inprocess, local or tcp://host:port'
+
+    return TcpExecutor(parse_address(spec), executor_key())
+
+
+@contextlib.contextmanager
+def executor_scope(executor: Executor | None = None, cores: int | None = None):
+    if executor is not None:
+        yield executor
+        return
+
+    with create_executor(cores=cores) as executor:
+        yield executor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run A/B test tasks for a tcp:// coordinator')
+    parser.add_argument('command', choices=['worker'])
+    parser.add_argument('address', help='coordinator host:port')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes to start on this machine')
+    parser.add_argument('--once', action='store_true', help='exit after the coordinator closes the connection')
+    args = parser.parse_args()
+
+    worker_address = parse_address(args.address)
+    worker_args = (worker_address, executor_key(), args.once)
+    if args.processes == 1:
+        serve_worker(*worker_args)
+    else:
+        processes = [multiprocessing.Process(target=serve_worker, args=worker_args) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -1,13 +1,68 @@
 from calculate import TestResult
+from executor import Executor
+from telemetry import span, traced_run
 
 
-def run_all_tests() -> dict[str, dict[str, list[TestResult]]]:
+def run_all_tests(
+        cores: int | None = None,
+        fast: bool = False,
+        executor: Executor | None = None,
+) -> dict[str, dict[str, list[TestResult]]]:
     from calculate import run_experiments
     from upload_datasets import upload_and_merge_datasets, get_dataset_names
 
-    experiments, df = upload_and_merge_datasets(get_dataset_names())
+    with traced_run('run_all_tests'):
+        experiments, df = upload_and_merge_datasets(get_dataset_names(), cores)
+        return run_experiments(df, experiments, cores, fast, executor)
 
-    return run_experiments(df, experiments)
+
+def run_incremental_tests(
+        cores: int | None = None,
+        fast: bool = False,
+        executor: Executor | None = None,
+) -> dict[str, dict[str, list[TestResult]]]:
+    from aggregate_store import AggregateStore, IncrementalUnsupported
+    from calculate import metrics, report_table, run_groups
+    from results_store import save_results
+    from upload_datasets import get_dataset_names
+
+    with traced_run('run_incremental_tests'):
+        store = AggregateStore()
+        store.load()
+        try:
+            with span('ingest'):
+                affected, summary = store.ingest(get_dataset_names(), cores)
+        except IncrementalUnsupported as e:
+            print(f'Warning! {e}; falling back to full recomputation')
+            store.clear()
+            return run_all_tests(cores, fast, executor)
+
+        previous = store.load_results(fast) if summary['days_skipped'] else {}
+        retest = sorted(experiment for experiment in store.arms if experiment in affected or experiment not in previous)
+
+        groups = {}
+        with span('prepare', experiments=len(retest)):
+            for experiment in retest:
+                groups.update(store.groups(experiment, metrics))
+        results = {
+            **{experiment: previous[experiment] for experiment in store.arms if experiment not in retest},
+            **run_groups(groups, cores, fast, executor),
+        }
+
+        store.save(results, fast)
+
+        print(
+            f'Incremental run: ingested {summary["days_ingested"]} of {summary["days_total"]} days '
+            f'({summary["days_skipped"]} skipped); re-tested {len(retest)} of {len(store.arms)} experiments '
+            f'({len(store.arms) - len(retest)} reused)'
+        )
+        with span('save_results'):
+            stored = save_results(results)
+        print(f'Results saved as run {stored.run_id}')
+        with span('report'):
+            report_table(stored.table)
+
+        return results
 
 
 if __name__ == '__main__':
@@ -1,36 +1,35 @@
 import numpy as np
-import pandas as pd
 from scipy import stats
 
-from preparation import get_aggregated_a_b_groups
+from resampling import bootstrap_a12, chunked_resample, is_binary, mannwhitney_from_counts
 
 
 def mannwhitney_test_impl(
         experiment: str,
         metric: str,
-        df: pd.DataFrame,
+        a: np.ndarray,
+        b: np.ndarray,
         alpha: float = 0.12,
         n_resamples: int = 10000,
+        chunks: int | None = None,
 ):
     from calculate import TestResult
-    rng = np.random.default_rng(8)
-
-    a, b = get_aggregated_a_b_groups(df, experiment, metric)
-
-    mw = stats.mannwhitneyu(a, b, alternative='two-sided', method='asymptotic')
-    p_mw = mw.pvalue
-    u_statistic = mw.statistic
+    seed = 8
 
     len_a, len_b = len(a), len(b)
+    if is_binary(a, b):
+        ones_a, ones_b = np.count_nonzero(a), np.count_nonzero(b)
+        u_statistic, p_mw = mannwhitney_from_counts(np.array([len_a - ones_a, ones_a]),
+                                                    np.array([len_b - ones_b, ones_b]))
+    else:
+        mw = stats.mannwhitneyu(a, b, alternative='two-sided', method='asymptotic')
+        p_mw = mw.pvalue
+        u_statistic = mw.statistic
+
     a_12 = u_statistic / (len_a * len_b)
     ci_level = 1 - alpha
 
-    boot_vals = np.empty(n_resamples, dtype=float)
-    for i in range(n_resamples):
-        a_s = rng.choice(a, size=len_a, replace=True)
-        b_s = rng.choice(b, size=len_b, replace=True)
-        u_s = stats.mannwhitneyu(a_s, b_s, alternative='two-sided', method='asymptotic').statistic
-        boot_vals[i] = u_s / (len_a * len_b)
+    boot_vals = chunked_resample(bootstrap_a12, (a, b), n_resamples, seed, chunks)
     ci_lo, ci_hi = np.percentile(boot_vals, [(1 - ci_level) / 2 * 100, (1 + ci_level) / 2 * 100])
 
     direction = None
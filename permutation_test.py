@@ -1,54 +1,49 @@
+import time
+
 import numpy as np
-import pandas as pd
-from scipy import stats
 
-from preparation import get_aggregated_a_b_groups
+from resample_cache import bootstrap_statistic, cached_resample
+from resampling import percentile_ci, sequential_permutation_test
+from sufficient_stats import SufficientStats, normal_mean_diff, permutation_null_p_value
 
 
 def permutation_test_impl(
         experiment: str,
         metric: str,
-        df: pd.DataFrame,
+        a: np.ndarray,
+        b: np.ndarray,
         alpha: float = 0.12,
         n_resamples: int = 10000,
+        fast: bool = False,
+        chunks: int | None = None,
+        method: str | None = None,
+        error_rate: float | None = 1e-3,
 ):
     from calculate import TestResult
-    rng = np.random.default_rng(8)
-
-    a, b = get_aggregated_a_b_groups(df, experiment, metric)
-
-    def diff_means(x, y):
-        return float(np.mean(y) - np.mean(x))
+    seed = 8
+    rng = np.random.default_rng(seed)
 
-    perm_res = stats.permutation_test(
-        data=(a, b),
-        statistic=diff_means,
-        permutation_type='independent',
-        alternative='two-sided',
-        n_resamples=n_resamples,
-        vectorized=False,
-        rng=rng,
-    )
-    p_perm = float(perm_res.pvalue)
+    if fast:
+        stats_a, stats_b = SufficientStats.from_array(a), SufficientStats.from_array(b)
+        p_perm = permutation_null_p_value(stats_a, stats_b)
+        ci_lo, ci_hi = normal_mean_diff(stats_a, stats_b, alpha).ci
+        resample_distribution, perm_null = None, None
+        n_permutations, time_saved = None, None
+    else:
+        started = time.perf_counter()
+        perm_res = sequential_permutation_test(a, b, n_resamples, rng, alpha, error_rate)
+        elapsed = time.perf_counter() - started
+        p_perm, perm_null, n_permutations = perm_res.p_value, perm_res.null_distribution, perm_res.n_resamples
+        time_saved = elapsed * (n_resamples - n_permutations) / n_permutations
 
-    conf_interval = stats.bootstrap(
-        data=(a, b),
-        statistic=diff_means,
-        paired=False,
-        confidence_level=1 - alpha,
-        vectorized=False,
-        n_resamples=n_resamples,
-        method='percentile',
-        rng=rng
-    )
+        resample_distribution = cached_resample(bootstrap_statistic(method), a, b, n_resamples, seed, chunks)
+        ci_lo, ci_hi = percentile_ci(resample_distribution, alpha)
 
     direction = None
     if p_perm > alpha:
         decision = 'REJECT'
         reason = f'p value > alpha; {p_perm} > {alpha} no meaningful difference between averages'
     else:
-        ci_lo = conf_interval.confidence_interval.low
-        ci_hi = conf_interval.confidence_interval.high
         if ci_lo <= 0 <= ci_hi:
             decision = 'KEEP_RUNNING'
             reason = (f'p value < alpha; {p_perm} < {alpha}, but 0 is in CI ({ci_lo}, {ci_hi}), not sure about '
@@ -68,10 +63,12 @@ def permutation_test_impl(
         decision=decision,
         reason=reason,
         direction=direction,
-        ci=conf_interval.confidence_interval,
+        ci=(ci_lo, ci_hi),
+        n_resamples=n_permutations,
+        time_saved=time_saved,
         vis_info={
-            'resample_distribution': conf_interval.bootstrap_distribution,
+            'resample_distribution': resample_distribution,
             'delta_hat': b.mean() - a.mean(),
-            'perm_null': perm_res.null_distribution
+            'perm_null': perm_null
         }
     )
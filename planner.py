@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from preparation import ABGroups
+
+min_nobs1 = 2.0
+refine_iterations = 60
+
+
+def normal_nobs1(effect_size: np.ndarray, alpha: np.ndarray, power: np.ndarray, ratio: np.ndarray) -> np.ndarray:
+    z = stats.norm.isf(alpha / 2) + stats.norm.ppf(power)
+    with np.errstate(divide='ignore'):
+        return z ** 2 * (1 + 1 / ratio) / effect_size ** 2
+
+
+def t_test_power(effect_size: np.ndarray, nobs1: np.ndarray, alpha: np.ndarray, ratio: np.ndarray) -> np.ndarray:
+    # same two-sided power as statsmodels TTestIndPower, evaluated for the whole grid at once
+    nobs2 = nobs1 * ratio
+    dof = nobs1 + nobs2 - 2
+    noncentrality = effect_size * np.sqrt(nobs1 * nobs2 / (nobs1 + nobs2))
+    critical = stats.t.isf(alpha / 2, dof)
+
+    return stats.nct.sf(critical, dof, noncentrality) + stats.nct.cdf(-critical, dof, noncentrality)
+
+
+def solve_nobs1(effect_size: np.ndarray, alpha: np.ndarray, power: np.ndarray, ratio: np.ndarray) -> np.ndarray:
+    effect_size, alpha, power, ratio = np.broadcast_arrays(
+        np.abs(np.asarray(effect_size, dtype=float)), np.asarray(alpha, dtype=float),
+        np.asarray(power, dtype=float), np.asarray(ratio, dtype=float),
+    )
+    nobs1 = np.full(effect_size.shape, np.inf)
+    solvable = np.isfinite(effect_size) & (effect_size > 0)
+    nobs1[np.isinf(effect_size)] = min_nobs1
+    if not solvable.any():
+        return nobs1
+
+    d, a, p, r = effect_size[solvable], alpha[solvable], power[solvable], ratio[solvable]
+    low = np.full(d.shape, min_nobs1)
+    high = np.maximum(2 * normal_nobs1(d, a, p, r), 4 * min_nobs1)
+    short = t_test_power(d, high, a, r) < p
+    while short.any():
+        high = np.where(short, 2 * high, high)
+        short = t_test_power(d, high, a, r) < p
+
+    # bisection keeps every grid point bracketed; the normal approximation only seeds the bracket
+    for _ in range(refine_iterations):
+        middle = (low + high) / 2
+        enough = t_test_power(d, middle, a, r) >= p
+        high = np.where(enough, middle, high)
+        low = np.where(enough, low, middle)
+
+    nobs1[solvable] = np.where(t_test_power(d, np.full(d.shape, min_nobs1), a, r) >= p, min_nobs1, high)
+    return nobs1
+
+
+def required_nobs1(effect_size, alpha, power, ratio) -> np.ndarray:
+    effect_size = np.asarray(effect_size, dtype=float)
+    effect_size = np.where(np.isnan(effect_size), 0.0, effect_size)
+    grid = np.broadcast_arrays(effect_size, *(np.asarray(x, dtype=float) for x in (alpha, power, ratio)))
+
+    # repeated grid points are solved once per call; nothing is kept between calls
+    points, inverse = np.unique(np.stack([np.ravel(x) for x in grid], axis=1), axis=0, return_inverse=True)
+    return solve_nobs1(*points.T)[inverse.ravel()].reshape(grid[0].shape)
+
+
+def daily_user_inflow(df: pd.DataFrame, selections: dict[str, np.ndarray]) -> dict[str, float]:
+    days = df['date'].to_numpy()
+    n_days = int(days.max()) + 1 if len(days) else 1
+    inflow = {}
+    for experiment, rows in selections.items():
+        users = df['user_id'].to_numpy()[rows]
+        first_days = pd.Series(days[rows]).groupby(users).min()
+        inflow[experiment] = len(first_days) / n_days
+
+    return inflow
+
+
+def store_daily_inflow(store) -> dict[str, float]:
+    first_days = store.columns['first_day']
+    n_days = int(store.max_day - first_days.min()) + 1 if len(first_days) else 1
+
+    return {experiment: float(np.count_nonzero(arms >= 0)) / n_days for experiment, arms in store.arms.items()}
+
+
+def plan(
+        groups: dict[tuple[str, str], ABGroups],
+        daily_inflow: dict[str, float],
+        effect_sizes: dict[str, list[float]],
+        alphas: list[float],
+        powers: list[float],
+) -> pd.DataFrame:
+    rows = []
+    for (experiment, metric), (a, b) in groups.items():
+        if len(a) == 0 or len(b) == 0 or metric not in effect_sizes:
+            continue
+        std = float(np.std(a))
+        for effect_size in effect_sizes[metric]:
+            for alpha in alphas:
+                for power in powers:
+                    rows.append({
+                        'experiment': experiment,
+                        'metric': metric,
+                        'effect_size': effect_size,
+                        'alpha': alpha,
+                        'power': power,
+                        'std': std,
+                        'n_a': len(a),
+                        'n_b': len(b),
+                    })
+
+    table = pd.DataFrame(rows, columns=['experiment', 'metric', 'effect_size', 'alpha', 'power', 'std', 'n_a', 'n_b'])
+    ratio = (table['n_b'] / table['n_a']).to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        standardized = (table['effect_size'] / table['std']).to_numpy()
+    table['standardized_effect'] = standardized
+    table['n_per_group'] = np.ceil(required_nobs1(standardized, table['alpha'].to_numpy(), table['power'].to_numpy(), ratio))
+    table['sufficient'] = (table['n_a'] >= table['n_per_group']) & (table['n_b'] >= table['n_per_group'])
+
+    # users still missing in the smaller arm, spread over the observed daily inflow split like the current arms
+    arm_share = np.minimum(table['n_a'], table['n_b']) / (table['n_a'] + table['n_b'])
+    missing = np.maximum(table['n_per_group'] - np.minimum(table['n_a'], table['n_b']), 0)
+    table['daily_inflow'] = table['experiment'].map(daily_inflow)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['days_to_sufficiency'] = np.ceil(missing / (table['daily_inflow'] * arm_share))
+
+    return table
+
+
+def default_effect_sizes() -> dict[str, list[float]]:
+    from t_test import effect_sizes
+
+    return {metric: [effect_size] for metric, effect_size in effect_sizes.items()}
+
+
+def plan_experiments(
+        df: pd.DataFrame,
+        experiments: list[str],
+        effect_sizes: dict[str, list[float]] | None = None,
+        alphas: list[float] = (0.12,),
+        powers: list[float] = (0.8,),
+) -> pd.DataFrame:
+    from calculate import metrics
+    from preparation import aggregate_experiment_groups, compute_user_retention, prepare_experiments
+
+    effect_sizes = effect_sizes or default_effect_sizes()
+    selections = prepare_experiments(df, experiments)
+    retention = compute_user_retention(df)
+    groups = {}
+    for experiment in experiments:
+        groups.update(aggregate_experiment_groups(df, experiment, metrics, selections[experiment], retention))
+
+    return plan(groups, daily_user_inflow(df, selections), effect_sizes, list(alphas), list(powers))
+
+
+def plan_store(
+        store,
+        effect_sizes: dict[str, list[float]] | None = None,
+        alphas: list[float] = (0.12,),
+        powers: list[float] = (0.8,),
+) -> pd.DataFrame:
+    from calculate import metrics
+
+    groups = {}
+    for experiment in store.arms:
+        groups.update(store.groups(experiment, metrics))
+
+    return plan(groups, store_daily_inflow(store), effect_sizes or default_effect_sizes(), list(alphas), list(powers))
@@ -1,97 +1,130 @@
-from functools import reduce
-
+import numpy as np
 import pandas as pd
-import pebble
-from scipy import stats
+
+from resampling import bootstrap_arm_means, chunked_resample
+
+
+def group_users(df: pd.DataFrame, experiment: str, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    inverse, users = pd.factorize(df['user_id'].to_numpy()[rows], sort=True)
+    arms = np.empty(len(users), dtype='int8')
+    arms[inverse] = df[experiment].to_numpy()[rows]
+
+    return np.asarray(users), arms, inverse
 
 
 def aggregate(column: str, metric: str):
-    def do(df: pd.DataFrame, experiment) -> pd.DataFrame:
-        return df.groupby(['user_id', experiment], as_index=False).agg(**{
-            metric: (column, 'sum')
-        })
+    def do(df: pd.DataFrame, experiment: str, rows: np.ndarray, retention: pd.DataFrame) -> pd.DataFrame:
+        users, arms, inverse = group_users(df, experiment, rows)
+        values = np.bincount(inverse, weights=df[column].to_numpy()[rows], minlength=len(users))
+
+        return pd.DataFrame({'user_id': users, experiment: arms, metric: values})
 
     return do
 
 
-def aggregate_user_retention(df: pd.DataFrame, experiment: str) -> pd.DataFrame:
-    first_day = df.groupby(['user_id'])['date'].min()
-    df['first_day'] = df['user_id'].map(first_day)
-    df['next_day'] = (df['date'] == df['first_day'] + pd.Timedelta(days=1)).astype(int)
+retention_days = {
+    'user_retention': 1,
+    'retention_d3': 3,
+    'retention_d7': 7,
+    'retention_d14': 14,
+}
+
+# user_retention keeps its original definition and counts every user; only the longer windows
+# leave out users whose window has not ended by the last day in the data
+uncensored_retention = {'user_retention'}
+
 
-    df = df.groupby(['user_id', experiment], as_index=False).agg(
-        user_retention=('next_day', 'sum')
-    )
+def compute_user_retention(df: pd.DataFrame) -> pd.DataFrame:
+    codes, users = pd.factorize(df['user_id'].to_numpy(), sort=True)
+    days = df['date'].to_numpy()
+    first_day = np.full(len(users), np.iinfo('int64').max)
+    np.minimum.at(first_day, codes, days)
 
-    df['user_retention'] = (df['user_retention'] > 0).astype(int)
+    offsets = days - first_day[codes]
+    windows = np.array(sorted(set(retention_days.values())))
+    position = np.searchsorted(windows, offsets).clip(0, len(windows) - 1)
+    hit = windows[position] == offsets
 
-    return df
+    retained = np.zeros((len(users), len(windows)), dtype=bool)
+    retained[codes[hit], position[hit]] = True
+    observable = first_day[:, None] + windows <= days.max()
+
+    columns = {}
+    for metric, window in retention_days.items():
+        i = np.searchsorted(windows, window)
+        columns[metric] = np.where(observable[:, i] | (metric in uncensored_retention), retained[:, i], np.nan)
+
+    return pd.DataFrame(columns, index=users)
+
+
+def aggregate_retention(metric: str):
+    def do(df: pd.DataFrame, experiment: str, rows: np.ndarray, retention: pd.DataFrame) -> pd.DataFrame:
+        users, arms, _ = group_users(df, experiment, rows)
+        values = retention[metric].to_numpy()[retention.index.get_indexer(users)]
+        observable = ~np.isnan(values)
+
+        return pd.DataFrame({
+            'user_id': users[observable],
+            experiment: arms[observable],
+            metric: values[observable].astype(int),
+        })
+
+    return do
 
 
 metrics_agg_map = {
     'arpu': aggregate('price_usd', 'arpu'),
     'messages': aggregate('messages_count', 'messages'),
-    'user_retention': aggregate_user_retention
+    **{metric: aggregate_retention(metric) for metric in retention_days},
 }
 
 
-def exclude_experiment_hopping_users(df: pd.DataFrame, experiment: str) -> pd.DataFrame:
-    df_count_before_filter = df.shape[0]
-    df = df[
-        df.groupby('user_id')[experiment].transform(lambda x: x.min() == x.max())
-    ]
+def prepare_experiments(df: pd.DataFrame, experiments: list[str]) -> dict[str, np.ndarray]:
+    arms = df[experiments]
+    grouped = arms.groupby(df['user_id'].to_numpy())
+    consistent = grouped.transform('min').to_numpy() == grouped.transform('max').to_numpy()
+    assigned = arms.to_numpy() >= 0
 
-    if df_count_before_filter != df.shape[0]:
-        print(f'Warning! Users change their A/B groups in experiment: {experiment}')
+    selections = {}
+    for i, experiment in enumerate(experiments):
+        if not consistent[:, i].all():
+            print(f'Warning! Users change their A/B groups in experiment: {experiment}')
+        selections[experiment] = np.flatnonzero(consistent[:, i] & assigned[:, i])
 
-    return df[df[experiment] >= 0]
+    return selections
 
 
-def prepare_for_experiment(df: pd.DataFrame, experiment: str) -> pd.DataFrame:
-    df[experiment] = df[experiment].fillna(-1).map({
-        -1: -1,
-        False: 0,
-        True: 1
-    })
+ABGroups = tuple[np.ndarray, np.ndarray]
 
-    preparations = [
-        exclude_experiment_hopping_users
-    ]
-    df = reduce(lambda acc, preparation: preparation(acc, experiment), preparations, df)
 
-    return df
+def get_aggregated_a_b_groups(
+        df: pd.DataFrame,
+        experiment: str,
+        metric: str,
+        rows: np.ndarray,
+        retention: pd.DataFrame,
+) -> ABGroups:
+    data = metrics_agg_map[metric](df, experiment, rows, retention)
 
+    a = data.loc[data[experiment] == 0, metric].to_numpy()
+    b = data.loc[data[experiment] == 1, metric].to_numpy()
 
-def get_aggregated_a_b_groups(df: pd.DataFrame, experiment: str, metric: str) -> tuple[pd.DataFrame, pd.DataFrame]:
-    data = metrics_agg_map[metric](df, experiment)
+    return a, b
 
-    a = data[data[experiment] == 0][metric]
-    b = data[data[experiment] == 1][metric]
 
-    return a, b
+def aggregate_experiment_groups(
+        df: pd.DataFrame,
+        experiment: str,
+        metrics: list[str],
+        rows: np.ndarray,
+        retention: pd.DataFrame,
+) -> dict[tuple[str, str], ABGroups]:
+    return {
+        (experiment, metric): get_aggregated_a_b_groups(df, experiment, metric, rows, retention)
+        for metric in metrics
+    }
 
 
-def bootstrap_resample(a: object, b: object, alpha: float, n_resamples: int, func: object, rng: object) -> tuple:
-    with pebble.ProcessPool(2) as pool:
-        a = pool.schedule(stats.bootstrap, kwargs=dict(
-            data=(a,),
-            statistic=func,
-            paired=False,
-            confidence_level=1 - alpha,
-            vectorized=False,
-            n_resamples=n_resamples,
-            method='percentile',
-            rng=rng
-        ))
-        b = pool.schedule(stats.bootstrap, kwargs=dict(
-            data=(b,),
-            statistic=func,
-            paired=False,
-            confidence_level=1 - alpha,
-            vectorized=False,
-            n_resamples=n_resamples,
-            method='percentile',
-            rng=rng
-        ))
-
-    return a.result(), b.result()
+def bootstrap_resample(a: np.ndarray, b: np.ndarray, n_resamples: int, seed: int, chunks: int | None = None) -> tuple:
+    means_a, means_b = chunked_resample(bootstrap_arm_means, (a, b), n_resamples, seed, chunks)
+    return means_a, means_b
@@ -0,0 +1,152 @@
+import contextlib
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from resampling import bootstrap_diff_means, chunked_resample, poisson_bootstrap_diff_means, resample_chunks
+
+resample_statistics: dict[str, Callable] = {
+    'diff_means': bootstrap_diff_means,
+    'poisson_diff_means': poisson_bootstrap_diff_means,
+}
+
+lock_poll_seconds = 0.05
+
+bootstrap_statistics = {
+    'multinomial': 'diff_means',
+    'poisson': 'poisson_diff_means',
+}
+
+
+def bootstrap_statistic(method: str | None = None) -> str:
+    method = method or os.environ.get('ABTESTS_BOOTSTRAP_METHOD', 'multinomial')
+    assert method in bootstrap_statistics, f'{method} not in bootstrap methods'
+
+    return bootstrap_statistics[method]
+
+
+def fingerprint(*arrays: np.ndarray) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f'{array.dtype.str}{array.shape}'.encode())
+        digest.update(array.data)
+
+    return digest.hexdigest()
+
+
+def lock_holder_alive(lock_path: Path) -> bool:
+    try:
+        pid = int(lock_path.read_text())
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # the holder has created the lock but not yet written its pid
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def load_distribution(path: Path) -> np.ndarray | None:
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class ResampleCache:
+    directory: Path
+
+    def __post_init__(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, statistic: str, arrays: tuple[np.ndarray, ...], n_resamples: int, seed: int, chunks: int) -> str:
+        return f'{statistic}-{fingerprint(*arrays)}-{n_resamples}-{seed}-{chunks}'
+
+    def record(self, hit: bool):
+        with open(self.directory / 'lookups', 'ab') as f:
+            f.write(b'h' if hit else b'm')
+
+    def record_lookups(self, hits: int, misses: int):
+        with open(self.directory / 'lookups', 'ab') as f:
+            f.write(b'h' * hits + b'm' * misses)
+
+    def get_or_compute(self, key: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        path = self.directory / f'{key}.npy'
+        lock_path = self.directory / f'{key}.lock'
+        while (distribution := load_distribution(path)) is None:
+            try:
+                lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # a concurrent task is computing the same distribution; waiting for it beats computing it twice
+                if not lock_holder_alive(lock_path):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(lock_path)
+                time.sleep(lock_poll_seconds)
+                continue
+
+            with os.fdopen(lock, 'w') as f:
+                f.write(str(os.getpid()))
+            try:
+                # the previous holder may have saved it between the load and taking the lock
+                distribution = load_distribution(path)
+                self.record(distribution is not None)
+                if distribution is None:
+                    distribution = compute()
+                    tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npy')
+                    np.save(tmp_path, distribution)
+                    os.replace(tmp_path, path)
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(lock_path)
+            return distribution
+
+        self.record(True)
+        return distribution
+
+    def stats(self) -> dict[str, int]:
+        try:
+            lookups = (self.directory / 'lookups').read_bytes()
+        except OSError:
+            lookups = b''
+
+        return {'hits': lookups.count(b'h'), 'misses': lookups.count(b'm')}
+
+
+active_cache: ResampleCache | None = None
+
+
+def use_resample_cache(cache: ResampleCache | None):
+    global active_cache
+    active_cache = cache
+
+
+def cached_resample(
+        statistic: str,
+        a: np.ndarray,
+        b: np.ndarray,
+        n_resamples: int,
+        seed: int,
+        chunks: int | None = None,
+) -> np.ndarray:
+    chunks = resample_chunks(chunks)
+
+    def compute():
+        return chunked_resample(resample_statistics[statistic], (a, b), n_resamples, seed, chunks)
+
+    if active_cache is None:
+        return compute()
+
+    return active_cache.get_or_compute(active_cache.key(statistic, (a, b), n_resamples, seed, chunks), compute)
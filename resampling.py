@@ -0,0 +1,264 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+from scipy import stats
+
+import scheduler
+
+max_block_bytes = 64 * 1024 * 1024
+sequential_block = 500
+binary_scan_values = 1 << 20
+
+
+def resamples_per_block(n: int, n_resamples: int, itemsize: int = 8) -> int:
+    return int(min(n_resamples, max(1, max_block_bytes // (max(n, 1) * itemsize))))
+
+
+def is_binary(*arrays: np.ndarray) -> bool:
+    # scanned in slices, so the check needs O(slice) memory and stops at the first non-binary slice
+    for x in map(np.asarray, arrays):
+        for start in range(0, len(x), binary_scan_values):
+            part = x[start:start + binary_scan_values]
+            if not ((part == 0) | (part == 1)).all():
+                return False
+
+    return True
+
+
+def bootstrap_proportions(x: np.ndarray, n_resamples: int, rng: np.random.Generator) -> np.ndarray:
+    n = len(x)
+    return rng.binomial(n, np.count_nonzero(x) / n, size=n_resamples) / n
+
+
+def bootstrap_means(x: np.ndarray, n_resamples: int, rng: np.random.Generator) -> np.ndarray:
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if is_binary(x):
+        return bootstrap_proportions(x, n_resamples, rng)
+    means = np.empty(n_resamples, dtype=float)
+
+    block = resamples_per_block(n, n_resamples)
+    for start in range(0, n_resamples, block):
+        stop = min(start + block, n_resamples)
+        idx = rng.integers(0, n, size=(stop - start, n))
+        means[start:stop] = x[idx].mean(axis=1)
+
+    return means
+
+
+def bootstrap_arm_means(a: np.ndarray, b: np.ndarray, n_resamples: int, rng: np.random.Generator) -> np.ndarray:
+    return np.stack([bootstrap_means(a, n_resamples, rng), bootstrap_means(b, n_resamples, rng)])
+
+
+def bootstrap_diff_means(a: np.ndarray, b: np.ndarray, n_resamples: int, rng: np.random.Generator) -> np.ndarray:
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    if is_binary(a, b):
+        return bootstrap_proportions(b, n_resamples, rng) - bootstrap_proportions(a, n_resamples, rng)
+
+    diffs = np.empty(n_resamples, dtype=float)
+
+    block = resamples_per_block(len(a) + len(b), n_resamples)
+    for start in range(0, n_resamples, block):
+        stop = min(start + block, n_resamples)
+        idx_a = rng.integers(0, len(a), size=(stop - start, len(a)))
+        idx_b = rng.integers(0, len(b), size=(stop - start, len(b)))
+        diffs[start:stop] = b[idx_b].mean(axis=1) - a[idx_a].mean(axis=1)
+
+    return diffs
+
+
+def poisson_bootstrap_sums(x: np.ndarray, n_resamples: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    if is_binary(x):
+        ones = np.count_nonzero(x)
+        weighted_ones = rng.poisson(ones, size=n_resamples).astype(float)
+        return weighted_ones, weighted_ones + rng.poisson(len(x) - ones, size=n_resamples)
+
+    sums = np.zeros(n_resamples, dtype=float)
+    weights = np.zeros(n_resamples, dtype=float)
+    chunk = resamples_per_block(n_resamples, len(x), itemsize=16)
+    for start in range(0, len(x), chunk):
+        values = np.asarray(x[start:start + chunk], dtype=float)
+        chunk_weights = rng.poisson(1.0, size=(n_resamples, len(values))).astype(float)
+        sums += chunk_weights @ values
+        weights += chunk_weights.sum(axis=1)
+
+    return sums, weights
+
+
+def poisson_bootstrap_diff_means(a: np.ndarray, b: np.ndarray, n_resamples: int,
+                                 rng: np.random.Generator) -> np.ndarray:
+    sums_a, weights_a = poisson_bootstrap_sums(a, n_resamples, rng)
+    sums_b, weights_b = poisson_bootstrap_sums(b, n_resamples, rng)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums_b / weights_b - sums_a / weights_a
+
+
+def value_histograms(a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    values, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+    counts_a = np.bincount(inverse[:len(a)], minlength=len(values))
+    counts_b = np.bincount(inverse[len(a):], minlength=len(values))
+
+    return values, counts_a, counts_b
+
+
+def a12_from_counts(counts_a: np.ndarray, counts_b: np.ndarray) -> np.ndarray:
+    len_a = counts_a.sum(axis=-1)
+    len_b = counts_b.sum(axis=-1)
+    b_below = np.cumsum(counts_b, axis=-1) - counts_b
+    u_statistic = (counts_a * (b_below + 0.5 * counts_b)).sum(axis=-1)
+
+    return u_statistic / (len_a * len_b)
+
+
+def permutation_diff_proportions(a: np.ndarray, b: np.ndarray, n_resamples: int,
+                                 rng: np.random.Generator) -> np.ndarray:
+    len_a, len_b = len(a), len(b)
+    ones = int(np.count_nonzero(a) + np.count_nonzero(b))
+    ones_b = rng.hypergeometric(ones, len_a + len_b - ones, len_b, size=n_resamples)
+
+    return ones_b / len_b - (ones - ones_b) / len_a
+
+
+def permutation_diff_means(a: np.ndarray, b: np.ndarray, n_resamples: int, rng: np.random.Generator) -> np.ndarray:
+    pooled = np.concatenate([a, b]).astype(float)
+    len_a, len_b = len(a), len(b)
+    total = pooled.sum()
+    diffs = np.empty(n_resamples, dtype=float)
+
+    block = resamples_per_block(len(pooled), n_resamples)
+    for start in range(0, n_resamples, block):
+        stop = min(start + block, n_resamples)
+        permuted = rng.permuted(np.broadcast_to(pooled, (stop - start, len(pooled))), axis=1)
+        sums_b = permuted[:, :len_b].sum(axis=1)
+        diffs[start:stop] = sums_b / len_b - (total - sums_b) / len_a
+
+    return diffs
+
+
+def tail_counts(null_distribution: np.ndarray, observed: float) -> tuple[int, int]:
+    gamma = abs(np.finfo(float).eps * 100 * observed)
+    return (int(np.count_nonzero(null_distribution <= observed + gamma)),
+            int(np.count_nonzero(null_distribution >= observed - gamma)))
+
+
+def is_decision_settled(exceedances: int, n_resamples: int, alpha: float, error_rate: float) -> bool:
+    # Clopper-Pearson bounds on the smaller tail probability; two-sided p is twice that
+    p_lo = stats.beta.ppf(error_rate / 2, exceedances, n_resamples - exceedances + 1) if exceedances else 0.0
+    p_hi = stats.beta.ppf(1 - error_rate / 2, exceedances + 1, n_resamples - exceedances)
+
+    return 2 * p_lo > alpha or 2 * p_hi < alpha
+
+
+@dataclass(frozen=True)
+class PermutationResult:
+    null_distribution: np.ndarray
+    p_value: float
+    n_resamples: int
+
+
+def sequential_permutation_test(
+        a: np.ndarray,
+        b: np.ndarray,
+        n_resamples: int,
+        rng: np.random.Generator,
+        alpha: float,
+        error_rate: float | None = 1e-3,
+) -> PermutationResult:
+    observed = float(np.mean(b) - np.mean(a))
+    permute = permutation_diff_proportions if is_binary(a, b) else permutation_diff_means
+    block = n_resamples if error_rate is None else min(sequential_block, n_resamples)
+    # the bound is checked after every block; splitting error_rate over all looks keeps the chance
+    # of any wrong early stop within error_rate
+    look_error_rate = None if error_rate is None else error_rate / -(-n_resamples // block)
+    null_distribution = np.empty(n_resamples, dtype=float)
+    n_less = n_greater = 0
+
+    done = 0
+    while done < n_resamples:
+        stop = min(done + block, n_resamples)
+        null_block = permute(a, b, stop - done, rng)
+        null_distribution[done:stop] = null_block
+        less, greater = tail_counts(null_block, observed)
+        n_less, n_greater, done = n_less + less, n_greater + greater, stop
+
+        if error_rate is not None and is_decision_settled(min(n_less, n_greater), done, alpha, look_error_rate):
+            break
+
+    p_value = min(1.0, 2 * (min(n_less, n_greater) + 1) / (done + 1))
+    return PermutationResult(null_distribution[:done], p_value, done)
+
+
+def mannwhitney_from_counts(counts_a: np.ndarray, counts_b: np.ndarray) -> tuple[float, float]:
+    len_a, len_b = int(counts_a.sum()), int(counts_b.sum())
+    n = len_a + len_b
+    u_statistic = float(a12_from_counts(counts_a, counts_b) * len_a * len_b)
+
+    ties = (counts_a + counts_b).astype(float)
+    tie_term = (ties ** 3 - ties).sum()
+    sigma = np.sqrt(len_a * len_b / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (max(u_statistic, len_a * len_b - u_statistic) - len_a * len_b / 2 - 0.5) / sigma
+
+    return u_statistic, float(np.clip(2 * stats.norm.sf(z), 0, 1))
+
+
+def bootstrap_a12(a: np.ndarray, b: np.ndarray, n_resamples: int, rng: np.random.Generator) -> np.ndarray:
+    if is_binary(a, b):
+        len_a, len_b = len(a), len(b)
+        ones_a = rng.binomial(len_a, np.count_nonzero(a) / len_a, size=n_resamples)
+        ones_b = rng.binomial(len_b, np.count_nonzero(b) / len_b, size=n_resamples)
+        return a12_from_counts(np.stack([len_a - ones_a, ones_a], axis=-1), np.stack([len_b - ones_b, ones_b], axis=-1))
+
+    _, counts_a, counts_b = value_histograms(np.asarray(a), np.asarray(b))
+    len_a, len_b = int(counts_a.sum()), int(counts_b.sum())
+    p_a, p_b = counts_a / len_a, counts_b / len_b
+    a_12 = np.empty(n_resamples, dtype=float)
+
+    block = resamples_per_block(2 * len(counts_a), n_resamples)
+    for start in range(0, n_resamples, block):
+        stop = min(start + block, n_resamples)
+        resampled_a = rng.multinomial(len_a, p_a, size=stop - start)
+        resampled_b = rng.multinomial(len_b, p_b, size=stop - start)
+        a_12[start:stop] = a12_from_counts(resampled_a, resampled_b)
+
+    return a_12
+
+
+def resample_chunks(chunks: int | None = None) -> int:
+    if chunks is None:
+        chunks = int(os.environ.get('ABTESTS_RESAMPLE_CHUNKS', 1))
+
+    return max(1, chunks)
+
+
+def chunked_resample(
+        resample: Callable[..., np.ndarray],
+        arrays: tuple[np.ndarray, ...],
+        n_resamples: int,
+        seed: int,
+        chunks: int | None = None,
+) -> np.ndarray:
+    chunks = min(resample_chunks(chunks), max(n_resamples, 1))
+    if chunks == 1:
+        return resample(*arrays, n_resamples, np.random.default_rng(seed))
+
+    # chunk sizes and child streams depend only on seed and chunk count, never on thread timing
+    sizes = np.diff(np.linspace(0, n_resamples, chunks + 1).astype(int))
+    streams = np.random.SeedSequence(seed).spawn(chunks)
+    # threads come from the core share the scheduler gave this task, so chunking never oversubscribes
+    with ThreadPoolExecutor(min(chunks, scheduler.thread_budget)) as pool:
+        parts = list(pool.map(
+            lambda size, stream: resample(*arrays, int(size), np.random.default_rng(stream)),
+            sizes, streams,
+        ))
+
+    return np.concatenate(parts, axis=-1)
+
+
+def percentile_ci(distribution: np.ndarray, alpha: float) -> tuple[float, float]:
+    ci_lo, ci_hi = np.percentile(distribution, [alpha / 2 * 100, (1 - alpha / 2) * 100])
+    return float(ci_lo), float(ci_hi)
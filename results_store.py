@@ -0,0 +1,173 @@
+import os
+import shutil
+from datetime import datetime
+from numbers import Number
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import read_frame, write_frame
+from upload_datasets import csv_path
+
+results_path = csv_path / '.results'
+
+# tests always report these, but fast runs leave them None and None values are not stored
+distribution_keys = ['resample_distribution', 'perm_null']
+
+scalar_columns = [
+    'experiment', 'metric', 'test_name', 'p_value', 'ci_lo', 'ci_hi',
+    'decision', 'direction', 'reason', 'n_resamples', 'time_saved',
+]
+
+
+def iter_results(results: dict) -> list:
+    return [
+        test_result
+        for experiment_results in results.values()
+        for metric_results in experiment_results.values()
+        for test_result in sorted(metric_results, key=lambda x: x.test_name)
+    ]
+
+
+def results_table(results: dict) -> pd.DataFrame:
+    rows = []
+    for test_result in iter_results(results):
+        ci_lo, ci_hi = test_result.ci if test_result.ci is not None else (np.nan, np.nan)
+        rows.append({
+            'experiment': test_result.experiment,
+            'metric': test_result.metric,
+            'test_name': test_result.test_name,
+            'p_value': float(test_result.p_value),
+            'ci_lo': float(ci_lo),
+            'ci_hi': float(ci_hi),
+            'decision': test_result.decision,
+            'direction': test_result.direction,
+            'reason': test_result.reason,
+            'n_resamples': np.nan if test_result.n_resamples is None else test_result.n_resamples,
+            'time_saved': np.nan if test_result.time_saved is None else test_result.time_saved,
+        })
+
+    return pd.DataFrame(rows, columns=scalar_columns)
+
+
+def new_run_id() -> str:
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def save_results(results: dict, directory: Path = results_path, run_id: str | None = None) -> 'StoredResults':
+    run_id = run_id or new_run_id()
+    tmp_directory = directory / f'{run_id}.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    tmp_directory.mkdir(parents=True)
+
+    table = results_table(results)
+    index_rows, arrays = [], []
+    offset = 0
+    for row, test_result in enumerate(iter_results(results)):
+        for key, value in (test_result.vis_info or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, Number):
+                table.loc[row, f'vis_{key}'] = float(value)
+                continue
+            value = np.asarray(value, dtype=float).ravel()
+            index_rows.append({'row': row, 'key': key, 'offset': offset, 'length': len(value)})
+            arrays.append(value)
+            offset += len(value)
+
+    distributions = np.lib.format.open_memmap(tmp_directory / 'distributions.npy', mode='w+', dtype=float, shape=(offset,))
+    for index_row, value in zip(index_rows, arrays):
+        distributions[index_row['offset']:index_row['offset'] + index_row['length']] = value
+    distributions.flush()
+    del distributions
+
+    table.insert(0, 'run', run_id)
+    write_frame(table, tmp_directory / 'table', {'run': run_id})
+    write_frame(pd.DataFrame(index_rows, columns=['row', 'key', 'offset', 'length']), tmp_directory / 'index')
+
+    os.replace(tmp_directory, directory / run_id)
+
+    return StoredResults(directory / run_id)
+
+
+def list_runs(directory: Path = results_path) -> list[str]:
+    if not directory.is_dir():
+        return []
+
+    return sorted(path.name for path in directory.iterdir() if path.is_dir() and not path.name.endswith('.tmp'))
+
+
+def load_results(run_id: str | None = None, directory: Path = results_path) -> 'StoredResults':
+    runs = list_runs(directory)
+    assert runs, f'no stored results in {directory}'
+
+    return StoredResults(directory / (run_id or runs[-1]))
+
+
+class StoredResults:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.run_id = directory.name
+        self.table = read_frame(directory / 'table')
+        self.index = read_frame(directory / 'index')
+        assert self.table is not None and self.index is not None, f'incomplete stored results in {directory}'
+        self._distributions: np.ndarray | None = None
+
+    @property
+    def distributions(self) -> np.ndarray:
+        if self._distributions is None:
+            self._distributions = np.load(self.directory / 'distributions.npy', mmap_mode='r')
+        return self._distributions
+
+    def select(self, experiment: str | None = None, metric: str | None = None,
+               test_name: str | None = None) -> pd.DataFrame:
+        mask = np.ones(len(self.table), dtype=bool)
+        for column, value in [('experiment', experiment), ('metric', metric), ('test_name', test_name)]:
+            if value is not None:
+                mask &= (self.table[column] == value).to_numpy()
+
+        return self.table[mask]
+
+    def distribution(self, row: int, key: str) -> np.ndarray | None:
+        entry = self.index[(self.index['row'] == row) & (self.index['key'] == key)]
+        if entry.empty:
+            return None
+
+        offset, length = int(entry['offset'].iloc[0]), int(entry['length'].iloc[0])
+        return self.distributions[offset:offset + length]
+
+    def result(self, row: int):
+        from calculate import TestResult
+
+        record = self.table.iloc[row]
+        vis_info = dict.fromkeys(distribution_keys)
+        vis_info.update({
+            column[len('vis_'):]: record[column]
+            for column in self.table.columns
+            if column.startswith('vis_') and not pd.isna(record[column])
+        })
+        for key in self.index.loc[self.index['row'] == row, 'key']:
+            vis_info[key] = self.distribution(row, key)
+
+        return TestResult(
+            test_name=record['test_name'],
+            experiment=record['experiment'],
+            metric=record['metric'],
+            p_value=record['p_value'],
+            ci=(record['ci_lo'], record['ci_hi']),
+            decision=record['decision'],
+            direction=record['direction'],
+            reason=record['reason'],
+            n_resamples=None if pd.isna(record['n_resamples']) else int(record['n_resamples']),
+            time_saved=None if pd.isna(record['time_saved']) else float(record['time_saved']),
+            vis_info=vis_info,
+        )
+
+    def results(self) -> dict:
+        results: dict = {}
+        for row in range(len(self.table)):
+            test_result = self.result(row)
+            results.setdefault(test_result.experiment, {}).setdefault(test_result.metric, []).append(test_result)
+
+        return results
@@ -0,0 +1,77 @@
+import os
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import pebble
+
+import telemetry
+
+
+# cores each running task may use for its own threads; set by run_tasks_untraced for the tasks it runs
+thread_budget = 1
+
+
+def set_thread_budget(threads: int):
+    global thread_budget
+    thread_budget = max(1, threads)
+
+
+@dataclass
+class Task:
+    func: Callable
+    args: tuple = ()
+    cost: float = 1.0
+    name: str = ''
+    kwargs: dict[str, Any] = field(default_factory=dict)
+
+
+def core_budget(cores: int | None = None) -> int:
+    if cores is None:
+        cores = int(os.environ.get('ABTESTS_CORES', 0)) or (os.cpu_count() or 1) - 2
+
+    return max(1, cores)
+
+
+def traced_task(task: Task) -> Task:
+    return Task(
+        func=telemetry.run_traced,
+        args=telemetry.traced_args(task.name, task.cost, task.func, task.args, task.kwargs),
+        cost=task.cost,
+        name=task.name,
+    )
+
+
+def run_tasks(tasks: list[Task], cores: int | None = None, executor=None) -> list[Any]:
+    run = executor.run if executor is not None else lambda tasks: run_tasks_untraced(tasks, cores)
+    if telemetry.enabled():
+        return [telemetry.collect(result) for result in run(list(map(traced_task, tasks)))]
+
+    return run(tasks)
+
+
+def run_tasks_untraced(tasks: list[Task], cores: int | None = None) -> list[Any]:
+    order = sorted(range(len(tasks)), key=lambda i: tasks[i].cost, reverse=True)
+    budget = core_budget(cores)
+    workers = min(budget, len(tasks))
+    threads = budget // max(workers, 1)
+    results: list[Any] = [None] * len(tasks)
+
+    if workers <= 1:
+        previous_budget = thread_budget
+        set_thread_budget(threads)
+        try:
+            for i in order:
+                results[i] = tasks[i].func(*tasks[i].args, **tasks[i].kwargs)
+        finally:
+            set_thread_budget(previous_budget)
+        return results
+
+    with pebble.ProcessPool(workers, initializer=set_thread_budget, initargs=(threads,)) as pool:
+        futures = {
+            i: pool.schedule(tasks[i].func, args=tasks[i].args, kwargs=tasks[i].kwargs)
+            for i in order
+        }
+        for i, future in futures.items():
+            results[i] = future.result()
+
+    return results
@@ -0,0 +1,338 @@
+import argparse
+import os
+import shutil
+import signal
+import socketserver
+import threading
+import time
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+
+import orjson
+import pebble
+
+from aggregate_store import AggregateStore, IncrementalUnsupported
+from calculate import build_groups, fast_tests, metrics, run_test, tests
+from preparation import ABGroups
+from resample_cache import ResampleCache
+from scheduler import core_budget
+from shared_arrays import ArrayHandle, SharedArrays
+from upload_datasets import csv_path, get_dataset_names, upload_and_merge_datasets
+
+default_host = '127.0.0.1'
+default_port = 8765
+default_reload_seconds = 5.0
+
+
+def warm_worker():
+    # workers import every test module (scipy included) once, before the first query reaches them
+    import calculate
+    import planner
+
+
+def dataset_signature(dataset_paths: dict) -> tuple:
+    signature = []
+    for dataset, datasets in sorted(dataset_paths.items()):
+        for _, dataset_path in sorted(datasets):
+            stat = dataset_path.stat()
+            signature.append((dataset, dataset_path.name, stat.st_mtime_ns, stat.st_size))
+
+    return tuple(signature)
+
+
+def result_payload(result, vis: bool = False) -> dict:
+    payload = asdict(result)
+    if not vis:
+        payload['vis_info'] = {
+            key: value for key, value in (result.vis_info or {}).items()
+            if value is None or isinstance(value, (int, float))
+        }
+
+    return payload
+
+
+class AnalysisService:
+    def __init__(self, directory: Path = csv_path, cores: int | None = None,
+                 reload_seconds: float = default_reload_seconds):
+        self.directory = directory
+        self.cores = cores
+        self.reload_seconds = reload_seconds
+        self.store = AggregateStore(directory / '.aggregates')
+        self.incremental = True
+        self.experiments: list[str] = []
+        self.groups: dict[tuple[str, str], ABGroups] = {}
+        self.handles: dict[tuple[str, str], tuple[ArrayHandle, ArrayHandle]] = {}
+        self.results: dict[tuple[str, str, str, bool], object] = {}
+        self.signature: tuple | None = None
+        self.generation = 0
+        self.loaded_at: float | None = None
+
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.in_flight = 0
+        self.reloading = False
+        self.stopped = threading.Event()
+
+        self.pool: pebble.ProcessPool | None = None
+        self.shared: SharedArrays | None = None
+        self.resample_cache: ResampleCache | None = None
+        self.watcher: threading.Thread | None = None
+
+    def __enter__(self) -> 'AnalysisService':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        # fork the workers before any data is loaded, so they do not carry copies of the datasets
+        self.pool = pebble.ProcessPool(core_budget(self.cores), initializer=warm_worker)
+        self.shared = SharedArrays().__enter__()
+        self.resample_cache = ResampleCache(self.shared.directory / 'resamples')
+
+        self.store.load()
+        self.refresh()
+        self.watcher = threading.Thread(target=self.watch, daemon=True)
+        self.watcher.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.shared is not None:
+            self.shared.close()
+
+    def watch(self):
+        while not self.stopped.wait(self.reload_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f'Warning! Reload failed: {e}')
+
+    def refresh(self, force: bool = False) -> bool:
+        signature = dataset_signature(get_dataset_names(self.directory, report=False))
+        if signature == self.signature and not force:
+            return False
+
+        with self.reload_lock, self.lock:
+            # closing the gate first keeps new queries out, so steady traffic cannot postpone the reload
+            self.reloading = True
+            try:
+                while self.in_flight:
+                    self.idle.wait()
+                self.reload(signature)
+            finally:
+                self.reloading = False
+                self.idle.notify_all()
+
+        return True
+
+    def reload(self, signature: tuple):
+        started = time.perf_counter()
+        dataset_paths = get_dataset_names(self.directory)
+        if self.incremental:
+            try:
+                affected, summary = self.store.ingest(dataset_paths, self.cores)
+                self.store.save()
+                stale = {experiment for experiment in self.experiments if experiment not in self.store.arms}
+                self.invalidate(affected | stale)
+                self.experiments = list(self.store.arms)
+                print(
+                    f'Reloaded: ingested {summary["days_ingested"]} of {summary["days_total"]} days; '
+                    f'{len(affected)} experiments changed in {time.perf_counter() - started:.1f}s'
+                )
+            except IncrementalUnsupported as e:
+                print(f'Warning! {e}; switching to full reloads')
+                self.store.clear()
+                self.incremental = False
+
+        if not self.incremental:
+            self.invalidate(set(self.experiments))
+            self.experiments, df = upload_and_merge_datasets(dataset_paths, self.cores)
+            self.groups = build_groups(df, self.experiments)
+            del df
+            print(f'Reloaded all datasets in {time.perf_counter() - started:.1f}s')
+
+        self.signature = signature
+        self.loaded_at = time.time()
+
+    def invalidate(self, experiments: set[str]):
+        if not experiments:
+            return
+
+        self.generation += 1
+        for key in [key for key in self.groups if key[0] in experiments]:
+            del self.groups[key]
+        for key in [key for key in self.handles if key[0] in experiments]:
+            for handle in self.handles.pop(key):
+                os.remove(handle.path)
+        for key in [key for key in self.results if key[1] in experiments]:
+            del self.results[key]
+
+        # distributions of replaced arrays are never looked up again
+        shutil.rmtree(self.resample_cache.directory, ignore_errors=True)
+        self.resample_cache.directory.mkdir(parents=True, exist_ok=True)
+
+    def group(self, experiment: str, metric: str) -> ABGroups:
+        assert experiment in self.experiments, f'{experiment} not in experiments'
+        assert metric in metrics, f'{metric} not in metrics'
+
+        if (experiment, metric) not in self.groups:
+            self.groups.update(self.store.groups(experiment, metrics))
+
+        return self.groups[experiment, metric]
+
+    def group_handles(self, experiment: str, metric: str) -> tuple[ArrayHandle, ArrayHandle]:
+        if (experiment, metric) not in self.handles:
+            a, b = self.group(experiment, metric)
+            assert len(a) and len(b), f'Not enough data for {experiment}-{metric}: group sizes a={len(a)} b={len(b)}'
+            self.handles[experiment, metric] = self.shared.publish(a), self.shared.publish(b)
+
+        return self.handles[experiment, metric]
+
+    def run(self, test_name: str, experiment: str, metric: str, fast: bool = False):
+        assert test_name in tests, f'{test_name} not in tests'
+
+        key = (test_name, experiment, metric, fast and test_name in fast_tests)
+        with self.lock:
+            while self.reloading:
+                self.idle.wait()
+            if key in self.results:
+                return self.results[key]
+            handles = self.group_handles(experiment, metric)
+            generation = self.generation
+            self.in_flight += 1
+
+        try:
+            future = self.pool.schedule(
+                run_test, args=((test_name, metric, experiment, *handles, key[3], self.resample_cache),)
+            )
+            result = future.result()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.idle.notify_all()
+
+        with self.lock:
+            if generation == self.generation:
+                self.results[key] = result
+
+        return result
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'experiments': self.experiments,
+                'metrics': metrics,
+                'tests': list(tests),
+                'incremental': self.incremental,
+                'days': len(self.store.days) if self.incremental else None,
+                'loaded_at': self.loaded_at,
+                'cached_results': len(self.results),
+                'resample_cache': self.resample_cache.stats(),
+            }
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service: AnalysisService
+
+    def reply(self, status: int, payload):
+        body = orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        def flag(name: str) -> bool:
+            return query.get(name, '0').lower() in ('1', 'true', 'yes')
+
+        try:
+            if url.path == '/status':
+                return self.reply(200, self.service.status())
+            if url.path == '/reload':
+                return self.reply(200, {'reloaded': self.service.refresh(force=flag('force'))})
+            if url.path == '/test':
+                started = time.perf_counter()
+                result = self.service.run(query.get('test', ''), query.get('experiment', ''),
+                                          query.get('metric', ''), flag('fast'))
+                return self.reply(200, {
+                    'result': result_payload(result, flag('vis')),
+                    'seconds': time.perf_counter() - started,
+                })
+            return self.reply(404, {'error': f'unknown path {url.path}'})
+        except AssertionError as e:
+            return self.reply(400, {'error': str(e)})
+        except Exception as e:
+            return self.reply(500, {'error': repr(e)})
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service: AnalysisService, host: str = default_host, port: int = default_port,
+          socket_path: Path | None = None):
+    handler = type('ServiceRequestHandler', (RequestHandler,), {'service': service})
+    if socket_path is not None:
+        socket_path.unlink(missing_ok=True)
+        server = UnixHTTPServer(str(socket_path), handler)
+        print(f'Serving on unix socket {socket_path}')
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f'Serving on http://{host}:{port}')
+
+    # SIGTERM shuts down as cleanly as Ctrl+C: workers are joined and shared arrays removed
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None:
+            socket_path.unlink(missing_ok=True)
+
+
+def query_test(test: str, experiment: str, metric: str, fast: bool = False,
+               url: str = f'http://{default_host}:{default_port}') -> dict:
+    params = urlencode({'test': test, 'experiment': experiment, 'metric': metric, 'fast': int(fast)})
+    with urlopen(f'{url}/test?{params}') as response:
+        return orjson.loads(response.read())['result']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve A/B test queries from resident datasets and warm workers')
+    parser.add_argument('directory', type=Path, nargs='?', default=csv_path)
+    parser.add_argument('--host', default=default_host)
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--socket', type=Path, help='listen on a unix socket instead of localhost TCP')
+    parser.add_argument('--cores', type=int)
+    parser.add_argument('--reload-seconds', type=float, default=default_reload_seconds)
+    args = parser.parse_args()
+
+    with AnalysisService(args.directory.resolve(), args.cores, args.reload_seconds) as analysis_service:
+        serve(analysis_service, args.host, args.port, args.socket)
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+shared_root = Path('/dev/shm') if Path('/dev/shm').is_dir() else Path(tempfile.gettempdir())
+shared_prefix = 'abtests-'
+
+
+@dataclass(frozen=True)
+class ArrayHandle:
+    path: str
+
+    def load(self) -> np.ndarray:
+        return np.load(self.path, mmap_mode='r')
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_stale_shared_arrays():
+    for directory in shared_root.glob(f'{shared_prefix}*'):
+        try:
+            owner_pid = int(directory.name[len(shared_prefix):].split('-')[0])
+        except ValueError:
+            continue
+        if not is_process_alive(owner_pid):
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class SharedArrays:
+    def __init__(self):
+        self.directory: Path | None = None
+        self.published = 0
+
+    def __enter__(self) -> 'SharedArrays':
+        remove_stale_shared_arrays()
+        self.directory = Path(tempfile.mkdtemp(prefix=f'{shared_prefix}{os.getpid()}-', dir=shared_root))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def publish(self, array: np.ndarray) -> ArrayHandle:
+        assert self.directory is not None, 'SharedArrays must be used as a context manager'
+
+        path = self.directory / f'{self.published}.npy'
+        np.save(path, np.ascontiguousarray(array))
+        self.published += 1
+
+        return ArrayHandle(str(path))
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
@@ -0,0 +1,79 @@
+from dataclasses import dataclass
+
+import numpy as np
+from scipy import stats
+
+
+@dataclass(frozen=True)
+class SufficientStats:
+    n: int = 0
+    total: float = 0.0
+    total_sq: float = 0.0
+
+    @classmethod
+    def from_array(cls, x: np.ndarray) -> 'SufficientStats':
+        x = np.asarray(x, dtype=float)
+        return cls(n=len(x), total=float(x.sum()), total_sq=float(np.dot(x, x)))
+
+    def __add__(self, other: 'SufficientStats') -> 'SufficientStats':
+        return SufficientStats(
+            n=self.n + other.n,
+            total=self.total + other.total,
+            total_sq=self.total_sq + other.total_sq,
+        )
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.n
+
+    @property
+    def variance(self) -> float:
+        if self.n < 2:
+            return 0.0
+        return max(self.total_sq - self.total * self.mean, 0.0) / (self.n - 1)
+
+
+@dataclass(frozen=True)
+class MeanDiffResult:
+    delta: float
+    se: float
+    statistic: float
+    dof: float
+    p_value: float
+    ci: tuple[float, float]
+
+
+def welch_t_test(a: SufficientStats, b: SufficientStats, alpha: float) -> MeanDiffResult:
+    delta = b.mean - a.mean
+    var_a, var_b = a.variance / a.n, b.variance / b.n
+    se = float(np.sqrt(var_a + var_b))
+
+    if se == 0:
+        p_value = 1.0 if delta == 0 else 0.0
+        return MeanDiffResult(delta, se, np.copysign(np.inf, delta) if delta else 0.0, np.nan, p_value, (delta, delta))
+
+    dof = (var_a + var_b) ** 2 / (var_a ** 2 / max(a.n - 1, 1) + var_b ** 2 / max(b.n - 1, 1))
+    statistic = delta / se
+    p_value = float(2 * stats.t.sf(abs(statistic), dof))
+    half_width = float(stats.t.ppf(1 - alpha / 2, dof)) * se
+
+    return MeanDiffResult(delta, se, statistic, dof, p_value, (delta - half_width, delta + half_width))
+
+
+def normal_mean_diff(a: SufficientStats, b: SufficientStats, alpha: float) -> MeanDiffResult:
+    delta = b.mean - a.mean
+    se = float(np.sqrt(a.variance / a.n + b.variance / b.n))
+    half_width = float(stats.norm.ppf(1 - alpha / 2)) * se
+    statistic = delta / se if se else 0.0
+
+    return MeanDiffResult(delta, se, statistic, np.inf, float(2 * stats.norm.sf(abs(statistic))),
+                          (delta - half_width, delta + half_width))
+
+
+def permutation_null_p_value(a: SufficientStats, b: SufficientStats) -> float:
+    pooled = a + b
+    se = float(np.sqrt(pooled.variance * (1 / a.n + 1 / b.n)))
+    if se == 0:
+        return 1.0
+
+    return float(2 * stats.norm.sf(abs(b.mean - a.mean) / se))
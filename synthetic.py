@@ -0,0 +1,150 @@
+import argparse
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+arm_unassigned = 2
+
+
+@dataclass
+class SyntheticConfig:
+    n_users: int = 100_000
+    n_days: int = 14
+    n_experiments: int = 2
+    start_date: date = date(2025, 1, 1)
+    daily_activity: float = 0.4
+    message_rate: float = 0.5
+    conversion_rate: float = 0.05
+    # relative lift of messages and conversion in arm 1 of the first experiment; the rest are A/A
+    lift: float = 0.1
+    unassigned_rate: float = 0.05
+    hopping_rate: float = 0.01
+    duplicate_payment_rate: float = 0.01
+    retry_payment_rate: float = 0.01
+    # few distinct prices and small message counts, so rank tests see many ties
+    tie_heavy: bool = True
+    seed: int = 8
+
+
+def ampl_user_data_strings(arms: np.ndarray) -> np.ndarray:
+    # one string per distinct assignment drawn, never all 3 ** n_experiments of them
+    assignments, inverse = np.unique(arms, axis=0, return_inverse=True)
+    strings = []
+    for states in assignments:
+        fields = [
+            f"'$exp{i + 1}': '{state}'"
+            for i, state in enumerate(states)
+            if state != arm_unassigned
+        ]
+        strings.append('{' + ', '.join(fields + ["'other': 'zz'"]) + '}')
+
+    return np.array(strings, dtype=object)[inverse.ravel()]
+
+
+def day_timestamps(day: date, n: int, rng: np.random.Generator) -> pd.DatetimeIndex:
+    return pd.Timestamp(day) + pd.to_timedelta(rng.integers(0, 24 * 3600 * 1000, size=n), unit='ms')
+
+
+def write_users(path: Path, day: date, user_ids: np.ndarray, arms: np.ndarray, rng: np.random.Generator):
+    pd.DataFrame({
+        'user_id': user_ids,
+        'ts': day_timestamps(day, len(user_ids), rng).floor('s'),
+        'ampl_user_data': ampl_user_data_strings(arms),
+    }).to_csv(path, index=False)
+
+
+def write_messages(path: Path, user_ids: np.ndarray, treated: np.ndarray, config: SyntheticConfig,
+                   rng: np.random.Generator):
+    rate = 1.5 if config.tie_heavy else 20.0
+    mean = rate * (1 + config.lift * treated)
+    if config.tie_heavy:
+        counts = rng.poisson(mean)
+    else:
+        counts = rng.negative_binomial(2, 2 / (2 + mean))
+    counts *= rng.random(len(user_ids)) < config.message_rate
+
+    sent = counts > 0
+    pd.DataFrame({'user_id': user_ids[sent], 'messages_count': counts[sent]}).to_csv(path, index=False)
+
+
+def write_payments(path: Path, day: date, user_ids: np.ndarray, treated: np.ndarray, config: SyntheticConfig,
+                   rng: np.random.Generator):
+    paid = rng.random(len(user_ids)) < config.conversion_rate * (1 + config.lift * treated)
+    payers = user_ids[paid]
+    if config.tie_heavy:
+        prices = rng.choice([0.99, 4.99, 9.99, 19.99], size=len(payers), p=[0.5, 0.3, 0.15, 0.05])
+    else:
+        prices = np.round(rng.lognormal(1.0, 1.0, size=len(payers)), 2)
+    payments = pd.DataFrame({
+        'insert_id': [f'{day.isoformat()}-{i}' for i in range(len(payers))],
+        'user_id': payers,
+        'ts': day_timestamps(day, len(payers), rng),
+        'price_usd': prices,
+    })
+
+    duplicates = payments[rng.random(len(payments)) < config.duplicate_payment_rate]
+    retries = payments[rng.random(len(payments)) < config.retry_payment_rate].copy()
+    retries['insert_id'] = retries['insert_id'] + '-retry'
+    retries['ts'] = retries['ts'] + pd.to_timedelta(rng.integers(1, 300, size=len(retries)), unit='ms')
+
+    pd.concat([payments, duplicates, retries]).to_csv(path, index=False)
+
+
+def generate_datasets(directory: Path, config: SyntheticConfig) -> list[Path]:
+    assert config.n_experiments >= 1, 'at least one experiment is required'
+
+    rng = np.random.default_rng(config.seed)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    user_ids = np.arange(1_000_000, 1_000_000 + config.n_users)
+    first_day = rng.integers(0, config.n_days, size=config.n_users)
+    arms = rng.integers(0, 2, size=(config.n_users, config.n_experiments))
+    arms[rng.random(arms.shape) < config.unassigned_rate] = arm_unassigned
+    hopping = rng.random(config.n_users) < config.hopping_rate
+
+    paths = []
+    for day_offset in range(config.n_days):
+        day = config.start_date + timedelta(days=day_offset)
+        active = (first_day == day_offset) | ((first_day < day_offset) & (rng.random(config.n_users) < config.daily_activity))
+
+        day_arms = arms[active]
+        flipped = hopping[active, None] & (rng.random(day_arms.shape) < 0.5) & (day_arms != arm_unassigned)
+        day_arms = np.where(flipped, 1 - day_arms, day_arms)
+        day_users = user_ids[active]
+        treated = (day_arms[:, 0] == 1).astype(float)
+
+        day_paths = [directory / f'{dataset}_all_{day.isoformat()}.csv' for dataset in ('users', 'messages', 'payments')]
+        write_users(day_paths[0], day, day_users, day_arms, rng)
+        write_messages(day_paths[1], day_users, treated, config, rng)
+        write_payments(day_paths[2], day, day_users, treated, config, rng)
+        paths.extend(day_paths)
+
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic users/messages/payments CSV files')
+    parser.add_argument('directory', type=Path, nargs='?', default=Path('./all_csv_files'))
+    parser.add_argument('--users', type=int, default=SyntheticConfig.n_users)
+    parser.add_argument('--days', type=int, default=SyntheticConfig.n_days)
+    parser.add_argument('--experiments', type=int, default=SyntheticConfig.n_experiments)
+    parser.add_argument('--conversion-rate', type=float, default=SyntheticConfig.conversion_rate)
+    parser.add_argument('--lift', type=float, default=SyntheticConfig.lift)
+    parser.add_argument('--hopping-rate', type=float, default=SyntheticConfig.hopping_rate)
+    parser.add_argument('--continuous', action='store_true', help='continuous prices and heavy-tailed messages')
+    parser.add_argument('--seed', type=int, default=SyntheticConfig.seed)
+    args = parser.parse_args()
+
+    generate_datasets(args.directory, SyntheticConfig(
+        n_users=args.users,
+        n_days=args.days,
+        n_experiments=args.experiments,
+        conversion_rate=args.conversion_rate,
+        lift=args.lift,
+        hopping_rate=args.hopping_rate,
+        tie_heavy=not args.continuous,
+        seed=args.seed,
+    ))
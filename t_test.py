@@ -1,25 +1,27 @@
 import numpy as np
-import pandas as pd
 from scipy.stats import ttest_ind
 from scipy.stats._stats_py import TtestResult
-from statsmodels.stats.power import TTestIndPower
 
-from preparation import get_aggregated_a_b_groups, bootstrap_resample
+from planner import required_nobs1
+from preparation import bootstrap_resample
+from sufficient_stats import SufficientStats, welch_t_test
 
 effect_sizes = {
     'arpu': 0.5,
     'messages': 5,
     'user_retention': 0.08,
+    'retention_d3': 0.08,
+    'retention_d7': 0.08,
+    'retention_d14': 0.08,
 }
 
 
 def calculate_sufficient_sample_groups(a, b, alpha: float, power: float, metric: str) -> tuple[bool, int]:
-    analysis = TTestIndPower()
     effect_size = effect_sizes[metric]
-    effect_size /= np.std(a)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effect_size /= np.std(a)
 
-    n_per_group = np.ceil(
-        analysis.solve_power(effect_size=effect_size, alpha=alpha, power=power, ratio=len(b) / len(a), alternative='two-sided'))
+    n_per_group = np.ceil(required_nobs1(effect_size, alpha, power, len(b) / len(a)))
 
     return len(a) >= n_per_group and len(b) >= n_per_group, n_per_group
 
@@ -27,14 +29,15 @@ def calculate_sufficient_sample_groups(a, b, alpha: float, power: float, metric:
 def t_test_impl(
         experiment: str,
         metric: str,
-        df: pd.DataFrame,
+        a: np.ndarray,
+        b: np.ndarray,
         alpha: float = 0.12,
         n_resamples: int = 10000,
+        fast: bool = False,
+        chunks: int | None = None,
 ):
     from calculate import TestResult
-    rng = np.random.default_rng(8)
-
-    a, b = get_aggregated_a_b_groups(df, experiment, metric)
+    seed = 8
 
     is_sufficient, n_per_group = calculate_sufficient_sample_groups(a, b, alpha, 0.8, metric)
     decision = None
@@ -44,19 +47,27 @@ def t_test_impl(
         reason = f'not sufficient group sizes; group sizes a={len(a)} b={len(b)}; required sample size: {n_per_group}'
         print(f'Warning! In t-test of {experiment}-{metric} there are {reason}')
 
-    n_resamples = max(n_resamples, n_per_group)
+    if fast:
+        welch = welch_t_test(SufficientStats.from_array(a), SufficientStats.from_array(b), alpha)
+        p_tt = welch.p_value
+        ci_lo, ci_hi = welch.ci
+        t_statistic, delta_hat, perm_null = welch.statistic, welch.delta, None
+    else:
+        n_resamples = int(max(n_resamples, n_per_group))
 
-    mean_bootstrap_a, mean_bootstrap_b = bootstrap_resample(a, b, alpha, n_resamples, np.mean, rng)
-    mean_bootstrap_a, mean_bootstrap_b = mean_bootstrap_a.bootstrap_distribution, mean_bootstrap_b.bootstrap_distribution
+        mean_bootstrap_a, mean_bootstrap_b = bootstrap_resample(a, b, n_resamples, seed, chunks)
 
-    test_result: TtestResult = ttest_ind(
-        mean_bootstrap_b,
-        mean_bootstrap_a,
-        alternative='two-sided',
-    )
+        test_result: TtestResult = ttest_ind(
+            mean_bootstrap_b,
+            mean_bootstrap_a,
+            alternative='two-sided',
+        )
 
-    p_tt = test_result.pvalue
-    ci_lo, ci_hi = test_result.confidence_interval(1 - alpha)
+        p_tt = test_result.pvalue
+        ci_lo, ci_hi = test_result.confidence_interval(1 - alpha)
+        t_statistic = test_result.statistic
+        delta_hat = mean_bootstrap_b.mean() - mean_bootstrap_a.mean()
+        perm_null = mean_bootstrap_b - mean_bootstrap_a
 
     direction = None
     if p_tt > alpha:
@@ -94,8 +105,8 @@ def t_test_impl(
         direction=direction,
         ci=(ci_lo, ci_hi),
         vis_info={
-            'resample_distribution': test_result.statistic,
-            'delta_hat': mean_bootstrap_b.mean() - mean_bootstrap_a.mean(),
-            'perm_null': mean_bootstrap_b - mean_bootstrap_a,
+            'resample_distribution': t_statistic,
+            'delta_hat': delta_hat,
+            'perm_null': perm_null,
         }
     )
@@ -0,0 +1,220 @@
+import contextlib
+import cProfile
+import json
+import os
+import re
+import resource
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Any, Callable
+
+trace_env = 'ABTESTS_TRACE'
+profile_env = 'ABTESTS_PROFILE_TASK'
+default_trace_dir = 'traces'
+memory_sample_seconds = 0.05
+
+disabled_span = contextlib.nullcontext()
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    # Linux resets VmHWM on this write; elsewhere the peak stays process-wide
+    with contextlib.suppress(OSError):
+        Path('/proc/self/clear_refs').write_text('5')
+
+
+def peak_rss_mb() -> float:
+    with contextlib.suppress(OSError):
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return max_rss_mb()
+
+
+def current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        return max_rss_mb()
+
+
+@dataclass
+class Trace:
+    directory: Path
+    profile_pattern: str | None = None
+    events: list[dict] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add(self, event: dict):
+        event.setdefault('pid', os.getpid())
+        event.setdefault('tid', threading.get_ident() % 2 ** 31)
+        with self.lock:
+            self.events.append(event)
+
+
+current: Trace | None = None
+
+
+def enabled() -> bool:
+    return current is not None
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, cat: str, args: dict):
+        self.trace = trace
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self) -> 'Span':
+        self.started_us = now_us()
+        self.started_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.trace.add({
+            'name': self.name,
+            'cat': self.cat,
+            'ph': 'X',
+            'ts': self.started_us,
+            'dur': now_us() - self.started_us,
+            'args': {
+                **self.args,
+                'cpu_ms': (time.process_time() - self.started_cpu) * 1000,
+                'max_rss_mb': max_rss_mb(),
+                **({'error': repr(exc_val)} if exc_val is not None else {}),
+            },
+        })
+
+
+def span(name: str, cat: str = 'stage', **args):
+    if current is None:
+        return disabled_span
+    return Span(current, name, cat, args)
+
+
+def count(name: str, **values: float):
+    if current is None:
+        return
+    current.add({'name': name, 'cat': 'count', 'ph': 'C', 'ts': now_us(), 'args': values})
+
+
+def sample_memory(trace: Trace, stop: threading.Event):
+    while not stop.wait(memory_sample_seconds):
+        trace.add({'name': 'rss_mb', 'cat': 'memory', 'ph': 'C', 'ts': now_us(), 'args': {'rss': current_rss_mb()}})
+
+
+def trace_directory() -> Path | None:
+    value = os.environ.get(trace_env, '')
+    if value.lower() in ('', '0', 'false'):
+        return None
+    if value.lower() in ('1', 'true'):
+        return Path(default_trace_dir)
+    return Path(value)
+
+
+@contextlib.contextmanager
+def traced_run(name: str):
+    global current
+
+    directory = trace_directory()
+    if directory is None or current is not None:
+        yield
+        return
+
+    current = Trace(directory, os.environ.get(profile_env))
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_memory, args=(current, stop), daemon=True)
+    sampler.start()
+    try:
+        with span(name, cat='run'):
+            yield
+    finally:
+        stop.set()
+        sampler.join()
+        trace, current = current, None
+        path = write_trace(trace, name)
+        print(f'Trace written to {path}')
+
+
+def write_trace(trace: Trace, name: str) -> Path:
+    trace.directory.mkdir(parents=True, exist_ok=True)
+    path = trace.directory / f'{name}-{datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.json'
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace.events, 'displayTimeUnit': 'ms'}, f)
+
+    return path
+
+
+@dataclass
+class TracedResult:
+    result: Any
+    events: list[dict]
+
+
+def profile_call(trace: Trace, name: str, func: Callable, args: tuple, kwargs: dict) -> tuple[Any, dict]:
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+    finally:
+        tracemalloc.stop()
+
+    trace.directory.mkdir(parents=True, exist_ok=True)
+    file_name = re.sub(r'[^\w.-]+', '_', name)
+    profile_path = trace.directory / f'{file_name}-{os.getpid()}.prof'
+    profiler.dump_stats(profile_path)
+
+    return result, {
+        'profile': str(profile_path),
+        'traced_peak_mb': peak / 1024 / 1024,
+        'top_allocations': [str(stat) for stat in top],
+    }
+
+
+def run_traced(directory: Path, profile_pattern: str | None, name: str, cost: float, submitted_us: int,
+               func: Callable, args: tuple, kwargs: dict) -> TracedResult:
+    global current
+
+    previous, current = current, Trace(directory, profile_pattern)
+    trace = current
+    started_us = now_us()
+    try:
+        with span(name, cat='task', cost=cost, queue_wait_ms=(started_us - submitted_us) / 1000) as task_span:
+            if profile_pattern and fnmatch(name, profile_pattern):
+                result, profile_args = profile_call(trace, name, func, args, kwargs)
+                task_span.args.update(profile_args)
+            else:
+                result = func(*args, **kwargs)
+        return TracedResult(result, trace.events)
+    finally:
+        current = previous
+
+
+def traced_args(name: str, cost: float, func: Callable, args: tuple, kwargs: dict) -> tuple:
+    return current.directory, current.profile_pattern, name, cost, now_us(), func, args, kwargs
+
+
+def collect(result: Any) -> Any:
+    if not isinstance(result, TracedResult):
+        return result
+    if current is not None:
+        with current.lock:
+            current.events.extend(result.events)
+
+    return result.result
@@ -1,10 +1,16 @@
+import time
 from datetime import datetime, date
 
+import numpy as np
 import pandas as pd
 import os
 from pathlib import Path
 from orjson import loads as json_loads
 
+from dataset_cache import cache_status, load_cached
+from scheduler import Task, run_tasks
+from telemetry import count, peak_rss_mb, reset_peak_rss, span
+
 csv_path = Path('./all_csv_files').resolve()
 
 DatasetsPaths = dict[str, list[tuple[date, Path]]]
@@ -17,21 +23,34 @@ payments_required_columns = [
     'insert_id', 'user_id', 'ts', 'price_usd',
 ]
 
+messages_required_columns = [
+    'user_id', 'messages_count',
+]
+
 dataset_columns_map = {
     'users': users_required_columns,
     'payments': payments_required_columns,
-    'messages': None
+    'messages': messages_required_columns,
+}
+
+dataset_dtypes_map = {
+    'users': {'ts': str, 'ampl_user_data': str},
+    'payments': {'insert_id': str, 'ts': str, 'price_usd': 'float64'},
+    'messages': {'messages_count': 'int32'},
 }
 
+large_file_bytes = 256 * 1024 * 1024
+chunk_rows = 1_000_000
+
 
-def get_dataset_names() -> DatasetsPaths:
+def get_dataset_names(directory: Path | None = None, report: bool = True) -> DatasetsPaths:
     result = {
         'users': [],
         'messages': [],
         'payments': []
     }
 
-    for file in csv_path.iterdir():
+    for file in (directory or csv_path).iterdir():
         if not file.is_file():
             continue
 
@@ -47,67 +66,179 @@ def get_dataset_names() -> DatasetsPaths:
 
     for dataset in result:
         result[dataset].sort(key=lambda x: x[0])
+        if report:
+            report_cache_status(dataset, result[dataset])
 
     return result
 
 
-def ampl_user_data_bad_json_parse(value: str):
-    result = {}
+def report_cache_status(dataset: str, datasets: list[tuple[date, Path]]):
+    statuses = {'cached': [], 'stale': [], 'new': []}
+    for dataset_date, dataset_path in datasets:
+        statuses[cache_status(dataset_path)].append(dataset_date.date().isoformat())
 
-    for key, value in json_loads(value.replace("'", '"')).items():
-        try:
-            result[key.strip('$')] = bool(int(value))
-        except (ValueError, TypeError):
-            result[key.strip('$')] = None
-    return result
+    print(f'{dataset}: {len(statuses["cached"])} cached, {len(statuses["stale"])} stale, {len(statuses["new"])} new')
+    if statuses['stale']:
+        print(f'- stale days: {", ".join(statuses["stale"])}')
+    if statuses['new']:
+        print(f'- new days: {", ".join(statuses["new"])}')
 
 
-def upload_dataset(prefix: str, dataset_path: Path, dataset_date: date, columns: list | None = None) -> pd.DataFrame:
-    df = pd.read_csv(
-        dataset_path,
+ampl_user_data_missing = -1
+
+
+def ampl_user_data_flag(value) -> int:
+    try:
+        return int(bool(int(value)))
+    except (ValueError, TypeError):
+        return ampl_user_data_missing
+
+
+def parse_ampl_user_data(values: pd.Series) -> pd.DataFrame:
+    codes, uniques = pd.factorize(values)
+    records = pd.DataFrame(json_loads(('[' + ','.join(uniques.astype(str)) + ']').replace("'", '"')))
+
+    data = {}
+    for raw_key in records.columns:
+        key = raw_key.strip('$')
+        if not key.startswith('exp'):
+            continue
+
+        value_codes, values_uniques = pd.factorize(records[raw_key])
+        flags = np.array([ampl_user_data_flag(value) for value in values_uniques] + [ampl_user_data_missing], dtype='int8')
+        column = np.append(flags[value_codes], np.int8(ampl_user_data_missing))
+        if key in data:
+            column = np.where(column != ampl_user_data_missing, column, data[key])
+        data[key] = column
+
+    return pd.DataFrame({key: column[codes] for key, column in data.items()}, index=values.index)
+
+
+def assemble_frames(dfs: list[pd.DataFrame]) -> pd.DataFrame:
+    columns = list(dict.fromkeys(col for df in dfs for col in df.columns))
+    dtypes = {
+        col: pd.concat([
+            df[col].iloc[:0] if col in df.columns else pd.Series(dtype=float)
+            for df in dfs
+        ]).dtype
+        for col in columns
+    }
+    offsets = np.cumsum([0] + [len(df) for df in dfs])
+    data = {col: np.empty(offsets[-1], dtype=dtypes[col]) for col in columns}
+
+    for i in range(len(dfs)):
+        df = dfs[i]
+        for col in columns:
+            if col in df.columns:
+                data[col][offsets[i]:offsets[i + 1]] = df[col].to_numpy()
+            else:
+                data[col][offsets[i]:offsets[i + 1]] = np.nan
+        dfs[i] = None
+
+    return pd.DataFrame(data, copy=False)
+
+
+def read_csv(prefix: str, dataset_path: Path, columns: list | None = None) -> pd.DataFrame:
+    kwargs = dict(
         usecols=columns if columns else None,
-        converters={'ampl_user_data': ampl_user_data_bad_json_parse}
+        dtype=dataset_dtypes_map[prefix],
     )
+    if dataset_path.stat().st_size < large_file_bytes:
+        return pd.read_csv(dataset_path, **kwargs)
+
+    with pd.read_csv(dataset_path, chunksize=chunk_rows, **kwargs) as chunks:
+        return assemble_frames(list(chunks))
+
+
+def upload_dataset(prefix: str, dataset_path: Path, dataset_date: date, columns: list | None = None) -> pd.DataFrame:
+    df = read_csv(prefix, dataset_path, columns)
     df['date'] = dataset_date
     return df
 
 
-def upload_all_datasets(prefix: str, datasets: list[tuple[date, Path]], columns: list | None) -> pd.DataFrame:
-    dfs = []
-    for dataset_date, dataset_path in datasets:
-        df = upload_dataset(prefix, dataset_path, dataset_date, columns)
-        dfs.append(df)
+def upload_users_dataset(dataset_path: Path, dataset_date: date) -> pd.DataFrame:
+    _, df = transform_users(upload_dataset('users', dataset_path, dataset_date, dataset_columns_map['users']))
+    return df
 
-    df = pd.concat(dfs, ignore_index=True)
 
-    return df
+def aggregate_user_days(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    return df.groupby(['user_id', 'date'], as_index=False, sort=False).agg(**{
+        column: (column, 'sum')
+    })
 
 
-def upload_all_users_datasets(datasets: list[tuple[date, Path]]) -> tuple[list[str], pd.DataFrame]:
-    dfs = []
-    experiments = set()
-    for dataset_date, dataset_path in datasets:
-        df = upload_dataset('users', dataset_path, dataset_date, dataset_columns_map['users'])
-        exps, df = transform_users(df)
-        experiments.update(exps)
-        dfs.append(df)
-    df = pd.concat(dfs, ignore_index=True)
+def parse_dataset(prefix: str, dataset_path: Path, dataset_date: date, columns: list | None) -> pd.DataFrame:
+    if prefix == 'users':
+        return upload_users_dataset(dataset_path, dataset_date)
+    if prefix == 'messages':
+        return aggregate_user_days(upload_dataset(prefix, dataset_path, dataset_date, columns), 'messages_count')
+    return upload_dataset(prefix, dataset_path, dataset_date, columns)
 
-    return list(experiments), df
 
+def ingest_dataset(prefix: str, dataset_path: Path, dataset_date: date, columns: list | None) -> dict:
+    # pool workers are reused across files, so the peak is reset per file instead of read process-wide
+    reset_peak_rss()
+    started = time.perf_counter()
+    df = load_cached(dataset_path, lambda: parse_dataset(prefix, dataset_path, dataset_date, columns))
 
-def transform_users(users: pd.DataFrame) -> tuple[set[str], pd.DataFrame]:
-    try:
-        df = pd.json_normalize(users['ampl_user_data'])
-    except Exception as e:
-        print(e)
+    return {
+        'file': dataset_path.name,
+        'rows': len(df),
+        'bytes': dataset_path.stat().st_size,
+        'seconds': time.perf_counter() - started,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def report_ingest(stats: dict):
+    megabytes = stats['bytes'] / 1024 / 1024
+    print(
+        f'{stats["file"]}: {stats["rows"]} rows, {megabytes:.1f} MB in {stats["seconds"]:.2f}s '
+        f'({megabytes / max(stats["seconds"], 1e-9):.1f} MB/s); peak RSS {stats["peak_rss_mb"]:.0f} MB'
+    )
 
-        raise e
 
-    df = pd.concat([users, df], axis=1)
+def upload_all_datasets(
+        prefix: str,
+        datasets: list[tuple[date, Path]],
+        columns: list | None,
+        cores: int | None = None,
+) -> pd.DataFrame:
+    tasks = [
+        Task(
+            func=ingest_dataset,
+            args=(prefix, dataset_path, dataset_date, columns),
+            cost=dataset_path.stat().st_size,
+            name=dataset_path.name,
+        )
+        for dataset_date, dataset_path in datasets
+        if cache_status(dataset_path) != 'cached'
+    ]
+    for stats in run_tasks(tasks, cores):
+        report_ingest(stats)
+
+    # an entry another process replaced meanwhile is parsed again rather than read
+    return assemble_frames([
+        load_cached(dataset_path, lambda: parse_dataset(prefix, dataset_path, dataset_date, columns))
+        for dataset_date, dataset_path in datasets
+    ])
+
+
+def upload_all_users_datasets(datasets: list[tuple[date, Path]], cores: int | None = None) -> tuple[list[str], pd.DataFrame]:
+    df = upload_all_datasets('users', datasets, dataset_columns_map['users'], cores)
+    experiments = [col for col in df.columns if col.startswith('exp')]
+    df[experiments] = df[experiments].fillna(ampl_user_data_missing).astype('int8')
+
+    return experiments, df
+
+
+def transform_users(users: pd.DataFrame) -> tuple[set[str], pd.DataFrame]:
+    flags = parse_ampl_user_data(users['ampl_user_data'])
+    df = pd.concat([users.drop(columns=['ampl_user_data']), flags], axis=1)
 
-    exp_cols = {col for col in df.columns if col.startswith('exp')}
-    df = df.drop(columns=['ampl_user_data']).dropna(subset=list(exp_cols), how='all')
+    exp_cols = set(flags.columns)
+    if exp_cols:
+        df = df[(flags != ampl_user_data_missing).any(axis=1)]
     df['ts'] = pd.to_datetime(df['ts'])
     df = df.sort_values(['user_id', 'ts'])
 
@@ -138,24 +269,79 @@ def transform_payments(payments: pd.DataFrame) -> pd.DataFrame:
     return filtered.drop(columns=['timedelta'])
 
 
-def upload_and_merge_datasets(dataset_paths: DatasetsPaths) -> tuple[list[str], pd.DataFrame]:
-    assert 'users' in dataset_paths
-    assert 'messages' in dataset_paths
-    assert 'payments' in dataset_paths
+def user_day_keys(user_codes: np.ndarray, dates: pd.Series, first_date) -> np.ndarray:
+    days = (pd.to_datetime(dates) - first_date).dt.days.to_numpy()
+    return user_codes.astype('int64') * (1 << 32) + days.astype('int64')
 
-    experiments, users_df = upload_all_users_datasets(dataset_paths.pop('users'))
 
-    messages = upload_all_datasets('messages', dataset_paths.pop('messages'), dataset_columns_map['messages'])
-    payments = upload_all_datasets('payments', dataset_paths.pop('payments'), dataset_columns_map['payments'])
-    payments = transform_payments(payments)
+def merge_user_days(users_df: pd.DataFrame, aggregates: list[tuple[pd.DataFrame, str]]) -> pd.DataFrame:
+    user_codes, user_ids = pd.factorize(users_df['user_id'])
+    first_date = pd.to_datetime(users_df['date']).min()
+    keys = user_day_keys(user_codes, users_df['date'], first_date)
 
-    merged = (
-        users_df.merge(messages, on=['user_id', 'date'], how='left')
-        .merge(payments, on=['user_id', 'date'], how='left')
-        .fillna({
-            'messages_count': 0,
-            'price_usd': 0
-        })
-    )
+    merged = users_df.reset_index(drop=True)
+    for aggregate, column in aggregates:
+        aggregate_codes = user_ids.get_indexer(aggregate['user_id'])
+        known = aggregate_codes >= 0
+        aggregate_keys = pd.Index(user_day_keys(aggregate_codes[known], aggregate['date'][known], first_date))
+        values = aggregate[column].to_numpy()[known]
+        if not aggregate_keys.is_unique:
+            # files covering the same date repeat user-days; they add up as they would in a merge
+            summed = pd.Series(values).groupby(aggregate_keys.to_numpy(), sort=False).sum()
+            aggregate_keys, values = summed.index, summed.to_numpy()
+
+        # misses are -1, so they read the zero appended after the values; this also covers empty aggregates
+        positions = aggregate_keys.get_indexer(keys)
+        merged[column] = np.append(values, np.zeros(1, dtype=values.dtype))[positions]
+
+    return merged
+
+
+def compact_merged_frame(df: pd.DataFrame, experiments: list[str]) -> pd.DataFrame:
+    user_codes, user_ids = pd.factorize(df['user_id'], sort=True)
+    dates = pd.to_datetime(df['date'])
+    first_date = dates.min()
+
+    compact = pd.DataFrame({
+        'user_id': user_codes.astype('int32'),
+        'date': (dates - first_date).dt.days.astype('int16'),
+        **{
+            experiment: df[experiment].fillna(ampl_user_data_missing).astype('int8')
+            for experiment in experiments
+        },
+        'messages_count': df['messages_count'].astype('int32'),
+        'price_usd': df['price_usd'].astype('float32'),
+    })
+    # pandas deep-copies attrs into every derived frame, so only scalars are kept here
+    compact.attrs['users'] = len(user_ids)
+    compact.attrs['first_date'] = first_date
+
+    return compact
+
+
+def upload_and_merge_datasets(dataset_paths: DatasetsPaths, cores: int | None = None) -> tuple[list[str], pd.DataFrame]:
+    assert 'users' in dataset_paths
+    assert 'messages' in dataset_paths
+    assert 'payments' in dataset_paths
 
-    return experiments, merged
+    with span('ingest:users', files=len(dataset_paths['users'])):
+        experiments, users_df = upload_all_users_datasets(dataset_paths.pop('users'), cores)
+    with span('ingest:messages', files=len(dataset_paths['messages'])):
+        messages = upload_all_datasets('messages', dataset_paths.pop('messages'), dataset_columns_map['messages'], cores)
+    with span('ingest:payments', files=len(dataset_paths['payments'])):
+        payments = upload_all_datasets('payments', dataset_paths.pop('payments'), dataset_columns_map['payments'], cores)
+    count('rows', users=len(users_df), messages=len(messages), payments=len(payments))
+
+    with span('transform_payments', rows=len(payments)):
+        payments = aggregate_user_days(transform_payments(payments), 'price_usd')
+
+    with span('merge', rows=len(users_df)):
+        merged = merge_user_days(users_df, [
+            (messages, 'messages_count'),
+            (payments, 'price_usd'),
+        ])
+    with span('compact', rows=len(merged)):
+        compact = compact_merged_frame(merged, experiments)
+    count('merged', rows=len(compact), users=compact.attrs['users'])
+
+    return experiments, compact